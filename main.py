@@ -7,18 +7,34 @@ import os
 import asyncio
 import time
 import uuid
-import requests
 import shutil
 import signal
 import sys
-import subprocess
 import json
 import logging
+import heapq
+import hashlib
+import re
+import random
+import sqlite3
+import threading
+import io
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
 
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, Optional
+import aiohttp
+from aiohttp import web
 from dotenv import load_dotenv
-from openai import OpenAI
-from pyrogram import Client, filters
+import httpx
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from pyrogram import Client, filters, idle
+from pyrogram.errors import FloodWait, MessageNotModified
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 from pyrogram.types import Message
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
@@ -34,6 +50,8 @@ logging.basicConfig(
     ]
 )
 logger = logging.getLogger("assemblyai_bot")
+# Оценки токенов и задержки по каждому запросу к ChatGPT (JSON в каждой строке)
+gpt_stats_logger = logging.getLogger("assemblyai_bot.gpt_stats")
 
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
@@ -41,18 +59,159 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+ASSEMBLYAI_BASE_URL = "https://api.assemblyai.com/v2"
+# Таймауты HTTP-запросов к AssemblyAI (в секундах)
+ASSEMBLYAI_UPLOAD_TIMEOUT = float(os.getenv("ASSEMBLYAI_UPLOAD_TIMEOUT", "300"))
+ASSEMBLYAI_REQUEST_TIMEOUT = float(os.getenv("ASSEMBLYAI_REQUEST_TIMEOUT", "30"))
+ASSEMBLYAI_CONNECT_TIMEOUT = float(os.getenv("ASSEMBLYAI_CONNECT_TIMEOUT", "10"))
+ASSEMBLYAI_KEEPALIVE_TIMEOUT = float(os.getenv("ASSEMBLYAI_KEEPALIVE_TIMEOUT", "60"))
+# Размер пула соединений с AssemblyAI (общий для всех обработчиков)
+ASSEMBLYAI_POOL_SIZE = int(os.getenv("ASSEMBLYAI_POOL_SIZE", "20"))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Повторные попытки загрузки при сетевых сбоях и ответах 5xx/429
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", "4"))
+UPLOAD_RETRY_BASE_DELAY = float(os.getenv("UPLOAD_RETRY_BASE_DELAY", "2"))
+UPLOAD_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Как часто обновлять прогресс загрузки в статусном сообщении (в секундах)
+UPLOAD_PROGRESS_INTERVAL = 5
+
+# Режим вебхуков: публичный URL, по которому AssemblyAI сообщит о завершении задания.
+# Если не задан, используется опрос статуса
+ASSEMBLYAI_WEBHOOK_URL = os.getenv("ASSEMBLYAI_WEBHOOK_URL")
+ASSEMBLYAI_WEBHOOK_SECRET = os.getenv("ASSEMBLYAI_WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/assemblyai/webhook")
+WEBHOOK_AUTH_HEADER = "X-Webhook-Secret"
+# Интервал страховочного опроса статуса в режиме вебхуков (в секундах)
+WEBHOOK_FALLBACK_POLL_INTERVAL = float(os.getenv("WEBHOOK_FALLBACK_POLL_INTERVAL", "30"))
+
+# Параметры адаптивного опроса статуса транскрипции (в секундах)
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "3"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "60"))
+POLL_BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "1.5"))
+# Ожидаемое время обработки как доля длительности аудио
+TRANSCRIPTION_TIME_RATIO = float(os.getenv("TRANSCRIPTION_TIME_RATIO", "0.15"))
+POLL_MAX_ERRORS = 5
+
+# Число одновременных процессов ffmpeg/ffprobe
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", str(os.cpu_count() or 1)))
+# Файлы больше этого размера перекодируются в MP3 перед отправкой
+COMPRESS_THRESHOLD = 20 * 1024 * 1024
+# Передавать вывод ffmpeg сразу в загрузку, без промежуточного файла
+STREAMING_TRANSCODE = os.getenv("STREAMING_TRANSCODE", "1") == "1"
+# Отдавать файл из Telegram в хэширование, ffmpeg и загрузку по мере скачивания
+MEDIA_PIPELINE = os.getenv("MEDIA_PIPELINE", "1") == "1"
+# Контейнеры, которые ffmpeg не может читать из непрерывного потока (индекс в конце файла)
+PIPELINE_SEEKABLE_EXTENSIONS = (".m4a", ".mp4", ".mov", ".3gp")
+
+# Число одновременно выполняемых заданий транскрипции
+TRANSCRIPTION_WORKERS = int(os.getenv("TRANSCRIPTION_WORKERS", "4"))
+
 CACHE_DIR = os.path.join(os.getcwd(), "cache")
 AUDIO_FILES_DIR = os.path.join(CACHE_DIR, "audio_files")
 SESSION_DIR = os.path.join(CACHE_DIR, "sessions")
+# Кэш готовых транскрипций переживает перезапуск бота
+TRANSCRIPT_CACHE_DIR = os.path.join(CACHE_DIR, "transcripts")
+TRANSCRIPT_CACHE_MAX_MB = float(os.getenv("TRANSCRIPT_CACHE_MAX_MB", "200"))
+TRANSCRIPT_CACHE_TTL = float(os.getenv("TRANSCRIPT_CACHE_TTL_DAYS", "30")) * 24 * 3600
+# Соответствие Telegram file_unique_id -> хэш содержимого
+FILE_ID_INDEX_PATH = os.path.join(TRANSCRIPT_CACHE_DIR, "file_ids.json")
+FILE_ID_INDEX_MAX_ENTRIES = 10000
+# Кэш ответов ChatGPT
+GPT_CACHE_DIR = os.path.join(CACHE_DIR, "gpt_results")
+GPT_CACHE_MAX_MB = float(os.getenv("GPT_CACHE_MAX_MB", "100"))
+GPT_CACHE_TTL = float(os.getenv("GPT_CACHE_TTL_DAYS", "7")) * 24 * 3600
+
+# Хранилище состояний и промптов пользователей: sqlite (переживает перезапуск) или memory
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.path.join(CACHE_DIR, "state.db")
+# Изменения состояний записываются в базу пачками раз в STATE_FLUSH_INTERVAL секунд
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))
+# Вытеснение сессий из памяти: по времени простоя и по общему объему (LRU)
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL_HOURS", "24")) * 3600
+SESSION_MEMORY_LIMIT = int(float(os.getenv("SESSION_MEMORY_LIMIT_MB", "200")) * 1024 * 1024)
+SESSION_SWEEP_INTERVAL = 60
 
 os.makedirs(CACHE_DIR, exist_ok=True)
 os.makedirs(AUDIO_FILES_DIR, exist_ok=True)
 os.makedirs(SESSION_DIR, exist_ok=True)
+os.makedirs(TRANSCRIPT_CACHE_DIR, exist_ok=True)
+os.makedirs(GPT_CACHE_DIR, exist_ok=True)
+
+# Минимальный интервал между редактированиями статусных сообщений в одном чате (в секундах)
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))
+PROGRESS_SENT_HISTORY = 10000
+
+# Ограничения исходящих запросов к Telegram: общий поток и отдельный чат (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_FLOOD_MAX_RETRIES = int(os.getenv("TELEGRAM_FLOOD_MAX_RETRIES", "5"))
+TELEGRAM_CHAT_BUCKETS_LIMIT = 10000
 
-# Создаем клиент OpenAI
+# Таймауты и пул соединений для OpenAI (в секундах)
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+# Клиентские ограничения частоты запросов (в минуту) для внешних API
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+ASSEMBLYAI_RPM = int(os.getenv("ASSEMBLYAI_RPM", "600"))
+# Сколько раз повторять запрос после ответа 429
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "5"))
+RATE_LIMIT_DEFAULT_RETRY_AFTER = 5.0
+RATE_LIMIT_MAX_JITTER = 1.0
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+# Потоковый вывод ответа ChatGPT с постепенным редактированием сообщения
+GPT_STREAMING = os.getenv("GPT_STREAMING", "1") == "1"
+# Минимальный интервал между редактированиями сообщения (в секундах)
+GPT_STREAM_EDIT_INTERVAL = float(os.getenv("GPT_STREAM_EDIT_INTERVAL", "1.5"))
+GPT_STREAM_PREVIEW_CHARS = 3500
+
+GPT_MODEL = "gpt-3.5-turbo"
+GPT_MAX_TOKENS = 2000
+# Тексты длиннее этого бюджета (в токенах) обрабатываются по частям (map-reduce)
+GPT_CHUNK_TOKENS = int(os.getenv("GPT_CHUNK_TOKENS", "6000"))
+# Сколько частей обрабатывается одновременно
+GPT_MAP_CONCURRENCY = int(os.getenv("GPT_MAP_CONCURRENCY", "4"))
+# Размер контекстного окна моделей (в токенах)
+GPT_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4o-mini": 128000,
+}
+# Таблица маршрутизации: первый подходящий маршрут по размеру текста (в токенах)
+# и классу промпта задает модель и max_tokens. Можно переопределить через GPT_ROUTES (JSON)
+DEFAULT_GPT_ROUTES = [
+    {"name": "short_summary", "prompt_class": "summary", "max_input_tokens": 1500, "model": "gpt-4o-mini", "max_tokens": 500},
+    {"name": "short", "max_input_tokens": 1500, "model": "gpt-4o-mini", "max_tokens": 2000},
+    {"name": "medium", "max_input_tokens": 12000, "model": "gpt-3.5-turbo", "max_tokens": 2000},
+    {"name": "long", "max_input_tokens": None, "model": "gpt-4o-mini", "max_tokens": 4000},
+]
+GPT_ROUTES = json.loads(os.getenv("GPT_ROUTES")) if os.getenv("GPT_ROUTES") else DEFAULT_GPT_ROUTES
+SUMMARY_PROMPT_RE = re.compile(r"сумм|кратк|резюм|summar|tl;?dr", re.IGNORECASE)
+# Тексты длиннее этого предела обрезаются до него перед обработкой по частям
+GPT_MAX_INPUT_TOKENS = int(os.getenv("GPT_MAX_INPUT_TOKENS", "400000"))
+# Накладные расходы на служебную разметку сообщений чата
+GPT_MESSAGE_OVERHEAD_TOKENS = 16
+
+# Создаем асинхронный клиент OpenAI с общим пулом соединений
 openai_client = None
 if OPENAI_API_KEY:
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    openai_client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        # Повторы выполняет openai_chat_create, чтобы 429 учитывались ограничителем
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_POOL_SIZE,
+                max_keepalive_connections=OPENAI_POOL_SIZE
+            ),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+        )
+    )
 
 DEFAULT_PROMPT = "Суммируй следующий текст в краткой форме, выделяя основные мысли и ключевые моменты."
 
@@ -68,6 +227,201 @@ user_current_prompts = {}
 MAX_STORED_PROMPTS = 5
 user_states = {}
 
+# Ключи состояния, которые ссылаются на удаляемые при очистке кэша файлы
+# или на незавершенные задачи, и не должны переживать перезапуск
+TRANSIENT_STATE_KEYS = ("file_path", "media", "content_hash", "transcribing", "awaiting_prompt")
+
+class MemoryStateBackend:
+    """Хранилище без сохранения: все данные живут только в словарях процесса"""
+
+    def load_user(self, username: str) -> Optional[Tuple[Dict[str, Any], list, Optional[str]]]:
+        return None
+
+    def save_users(self, rows) -> None:
+        pass
+
+    def reset_transient(self, keys) -> None:
+        pass
+
+class SQLiteStateBackend:
+    """Хранилище состояний и промптов в SQLite (WAL), одна строка на пользователя"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_data ("
+            "username TEXT PRIMARY KEY, "
+            "state TEXT NOT NULL, "
+            "prompts TEXT NOT NULL, "
+            "current_prompt TEXT, "
+            "updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load_user(self, username: str) -> Optional[Tuple[Dict[str, Any], list, Optional[str]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, prompts, current_prompt FROM user_data WHERE username = ?",
+                (username,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]), row[2]
+
+    def save_users(self, rows) -> None:
+        """rows: список (username, state, prompts, current_prompt), пишется одной транзакцией"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO user_data (username, state, prompts, current_prompt, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(username) DO UPDATE SET "
+                    "state = excluded.state, prompts = excluded.prompts, "
+                    "current_prompt = excluded.current_prompt, updated_at = excluded.updated_at",
+                    [
+                        (username, json.dumps(state, ensure_ascii=False, default=str),
+                         json.dumps(prompts, ensure_ascii=False), current_prompt, now)
+                        for username, state, prompts, current_prompt in rows
+                    ]
+                )
+
+    def reset_transient(self, keys) -> None:
+        with self._lock:
+            with self._conn:
+                for username, state in self._conn.execute("SELECT username, state FROM user_data").fetchall():
+                    data = json.loads(state)
+                    if any(key in data for key in keys):
+                        for key in keys:
+                            data.pop(key, None)
+                        self._conn.execute(
+                            "UPDATE user_data SET state = ? WHERE username = ?",
+                            (json.dumps(data, ensure_ascii=False, default=str), username)
+                        )
+
+if STATE_BACKEND == "sqlite":
+    state_backend = SQLiteStateBackend(STATE_DB_PATH)
+else:
+    state_backend = MemoryStateBackend()
+
+# Пользователи, чьи данные уже подняты из хранилища, и те, чьи изменения еще не записаны
+_loaded_users = set()
+_dirty_users = set()
+# Время последнего обращения к сессии, от давних к недавним
+_session_access: "OrderedDict[str, float]" = OrderedDict()
+
+def load_user_data(username: str) -> None:
+    """Поднимает данные пользователя из хранилища при первом обращении"""
+    _session_access[username] = time.monotonic()
+    _session_access.move_to_end(username)
+    if username in _loaded_users:
+        return
+    _loaded_users.add(username)
+    data = state_backend.load_user(username)
+    if data is None:
+        return
+    state, prompts, current_prompt = data
+    user_states.setdefault(username, {}).update(state)
+    user_prompts.setdefault(username, prompts)
+    if current_prompt is not None:
+        user_current_prompts.setdefault(username, current_prompt)
+
+def mark_dirty(username: str) -> None:
+    _dirty_users.add(username)
+
+def _collect_dirty_rows():
+    rows = [
+        (username, dict(user_states.get(username, {})), list(user_prompts.get(username, [])), user_current_prompts.get(username))
+        for username in _dirty_users
+    ]
+    _dirty_users.clear()
+    return rows
+
+async def flush_state() -> None:
+    """Записывает накопленные изменения одной транзакцией вне event loop"""
+    if not _dirty_users:
+        return
+    rows = _collect_dirty_rows()
+    try:
+        await asyncio.to_thread(state_backend.save_users, rows)
+    except Exception as e:
+        logger.error(f"Ошибка записи состояний пользователей: {e}", exc_info=True)
+        for row in rows:
+            _dirty_users.add(row[0])
+
+def flush_state_sync() -> None:
+    if not _dirty_users:
+        return
+    try:
+        state_backend.save_users(_collect_dirty_rows())
+    except Exception as e:
+        logger.error(f"Ошибка записи состояний пользователей: {e}", exc_info=True)
+
+async def state_flush_loop() -> None:
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        await flush_state()
+
+def estimate_size(value: Any) -> int:
+    """Приблизительный объем памяти, занимаемый значением состояния"""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+def session_memory_stats() -> Dict[str, int]:
+    """Байты, занимаемые сессией каждого пользователя в памяти"""
+    return {username: estimate_size(state) for username, state in user_states.items()}
+
+def evict_session(username: str) -> None:
+    """
+    Убирает сессию из памяти. С SQLite она поднимется из базы при следующем
+    обращении, в режиме memory данные сессии теряются
+    """
+    user_states.pop(username, None)
+    _session_access.pop(username, None)
+    _loaded_users.discard(username)
+
+async def evict_sessions() -> None:
+    # Несохраненные изменения сначала пишем в базу, иначе вытеснение их потеряет
+    await flush_state()
+    now = time.monotonic()
+    evicted = 0
+
+    for username, last_access in list(_session_access.items()):
+        if now - last_access <= SESSION_IDLE_TTL:
+            break
+        if username not in _dirty_users:
+            evict_session(username)
+            evicted += 1
+
+    sizes = session_memory_stats()
+    total = sum(sizes.values())
+    for username in list(_session_access):
+        if total <= SESSION_MEMORY_LIMIT:
+            break
+        if username in _dirty_users:
+            continue
+        total -= sizes.get(username, 0)
+        evict_session(username)
+        evicted += 1
+
+    if evicted:
+        logger.info(f"Вытеснено сессий: {evicted}, в памяти: {len(user_states)}, объем: {total / (1024 * 1024):.1f} МБ")
+
+async def session_eviction_loop() -> None:
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            await evict_sessions()
+        except Exception as e:
+            logger.error(f"Ошибка при вытеснении сессий: {e}", exc_info=True)
+
 def clean_cache():
     """Очистка всех кэш-директорий"""
     print("Очистка кэша...")
@@ -80,7 +434,16 @@ def clean_cache():
                 elif os.path.isdir(file_path):
                     shutil.rmtree(file_path)
         
+        # Сохраненные данные пользователей не теряются: сбрасываем только
+        # ссылки на удаленные файлы и незавершенные задачи
+        flush_state_sync()
+        state_backend.reset_transient(TRANSIENT_STATE_KEYS)
         user_states.clear()
+        if not isinstance(state_backend, MemoryStateBackend):
+            user_prompts.clear()
+            user_current_prompts.clear()
+            _loaded_users.clear()
+        _session_access.clear()
         print("Кэш очищен")
     except Exception as e:
         print(f"Ошибка при очистке кэша: {e}")
@@ -105,25 +468,909 @@ app = Client(
 
 def get_state(username: str) -> Dict[str, Any]:
     """Получение состояния пользователя"""
+    load_user_data(username)
     if username not in user_states:
         user_states[username] = {}
     return user_states[username]
 
 def set_state(username: str, key: str, value: Any) -> None:
     """Установка значения в состоянии пользователя"""
+    load_user_data(username)
     if username not in user_states:
         user_states[username] = {}
     user_states[username][key] = value
+    mark_dirty(username)
 
 def clear_state(username: str, key: str = None) -> None:
     """Очистка состояния пользователя"""
+    load_user_data(username)
     if username in user_states:
         if key and key in user_states[username]:
             del user_states[username][key]
         else:
             user_states[username] = {}
+        mark_dirty(username)
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов к внешнему API: token bucket по запросам
+    и (опционально) по токенам в минуту. Вызывающие ждут своей очереди в порядке
+    поступления, а после ответа 429 весь поток запросов приостанавливается на Retry-After
+    """
+
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: Optional[int] = None):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute or 0)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+        self.waiting = 0
+        self.total_wait = 0.0
+        self.rate_limited = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(
+            float(self.requests_per_minute),
+            self._request_allowance + elapsed * self.requests_per_minute / 60
+        )
+        if self.tokens_per_minute:
+            self._token_allowance = min(
+                float(self.tokens_per_minute),
+                self._token_allowance + elapsed * self.tokens_per_minute / 60
+            )
+
+    def _delay_for(self, tokens: int) -> float:
+        delay = max(0.0, self._blocked_until - time.monotonic())
+        if self._request_allowance < 1:
+            delay = max(delay, (1 - self._request_allowance) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self._token_allowance < tokens:
+            delay = max(delay, (tokens - self._token_allowance) * 60 / self.tokens_per_minute)
+        return delay
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Ждет, пока можно отправить запрос размером tokens"""
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        self.waiting += 1
+        start_time = time.monotonic()
+        try:
+            async with self._lock:
+                while True:
+                    self._refill()
+                    delay = self._delay_for(tokens)
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self._request_allowance -= 1
+                if self.tokens_per_minute:
+                    self._token_allowance -= tokens
+        finally:
+            self.waiting -= 1
+            self.total_wait += time.monotonic() - start_time
+
+    def penalize(self, retry_after: float) -> float:
+        """Приостанавливает запросы после 429; возвращает фактическую паузу с учетом jitter"""
+        delay = retry_after + random.uniform(0, RATE_LIMIT_MAX_JITTER)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        self.rate_limited += 1
+        logger.warning(f"{self.name}: получен 429, пауза {delay:.1f}с")
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "name": self.name,
+            "requests_available": round(self._request_allowance, 1),
+            "tokens_available": round(self._token_allowance) if self.tokens_per_minute else None,
+            "waiting": self.waiting,
+            "blocked_for": round(max(0.0, self._blocked_until - time.monotonic()), 1),
+            "total_wait": round(self.total_wait, 1),
+            "rate_limited": self.rate_limited,
+        }
 
-def get_audio_duration(file_path):
+def parse_retry_after(headers, default: float = RATE_LIMIT_DEFAULT_RETRY_AFTER) -> float:
+    """Пауза из заголовков retry-after-ms / Retry-After (секунды или HTTP-дата)"""
+    if headers is None:
+        return default
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    if not retry_after:
+        return default
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+assemblyai_limiter = RateLimiter("AssemblyAI", ASSEMBLYAI_RPM)
+openai_limiter = RateLimiter("OpenAI", OPENAI_RPM, OPENAI_TPM)
+
+class AssemblyAIClient:
+    """Асинхронный клиент AssemblyAI API поверх aiohttp"""
+
+    def __init__(self, api_key: str, base_url: str = ASSEMBLYAI_BASE_URL, pool_size: int = ASSEMBLYAI_POOL_SIZE, limiter: Optional[RateLimiter] = None):
+        self.api_key = api_key
+        self.limiter = limiter
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> None:
+        """Создает общую сессию с пулом keep-alive соединений"""
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size,
+            keepalive_timeout=ASSEMBLYAI_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"authorization": self.api_key},
+            timeout=aiohttp.ClientTimeout(
+                total=ASSEMBLYAI_REQUEST_TIMEOUT,
+                connect=ASSEMBLYAI_CONNECT_TIMEOUT
+            )
+        )
+        logger.info(f"Пул соединений AssemblyAI создан, размер: {self.pool_size}")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("Клиент AssemblyAI не запущен")
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, method: str, path: str, retry_rate_limited: bool = True, **kwargs) -> Tuple[int, Any]:
+        """
+        Выполняет запрос и возвращает (статус, JSON при 200 или текст ответа).
+        Ответ 429 приостанавливает ограничитель на Retry-After; запрос повторяется,
+        если тело можно отправить повторно (retry_rate_limited)
+        """
+        attempts = RATE_LIMIT_MAX_RETRIES + 1 if retry_rate_limited else 1
+        for attempt in range(1, attempts + 1):
+            if self.limiter:
+                await self.limiter.acquire()
+            async with self.session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+                if response.status == 429 and self.limiter:
+                    self.limiter.penalize(parse_retry_after(response.headers))
+                    if attempt < attempts:
+                        continue
+                if response.status == 200:
+                    return response.status, await response.json()
+                return response.status, await response.text()
+
+    async def upload(self, audio_path: str, progress=None) -> Tuple[int, Any]:
+        """Загрузка файла в AssemblyAI без блокировки event loop"""
+        total = os.path.getsize(audio_path)
+        return await self.upload_stream(lambda: read_file_chunks(audio_path), progress, total)
+
+    async def upload_stream(self, chunks_factory, progress=None, total: Optional[int] = None) -> Tuple[int, Any]:
+        """
+        Загрузка из асинхронного итератора байтов (chunked transfer encoding).
+        chunks_factory должна создавать новый итератор на каждую попытку:
+        /v2/upload не умеет докачку, поэтому при сбое тело отправляется заново
+        с экспоненциальной паузой между попытками
+        """
+        timeout = aiohttp.ClientTimeout(
+            total=ASSEMBLYAI_UPLOAD_TIMEOUT,
+            connect=ASSEMBLYAI_CONNECT_TIMEOUT
+        )
+        for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+            try:
+                status_code, response_data = await self._request(
+                    "POST", "/upload",
+                    retry_rate_limited=False,
+                    data=track_upload_progress(chunks_factory(), progress, total),
+                    headers={"content-type": "application/octet-stream"},
+                    timeout=timeout
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == UPLOAD_MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"Сбой загрузки (попытка {attempt}/{UPLOAD_MAX_ATTEMPTS}): {e}")
+            else:
+                if status_code not in UPLOAD_RETRY_STATUSES or attempt == UPLOAD_MAX_ATTEMPTS:
+                    return status_code, response_data
+                logger.warning(f"Ошибка загрузки {status_code} (попытка {attempt}/{UPLOAD_MAX_ATTEMPTS}): {response_data}")
+            await asyncio.sleep(UPLOAD_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+
+    async def create_transcript(self, data: Dict[str, Any]) -> Tuple[int, Any]:
+        return await self._request("POST", "/transcript", json=data)
+
+    async def get_transcript(self, transcript_id: str) -> Tuple[int, Any]:
+        return await self._request("GET", f"/transcript/{transcript_id}")
+
+async def read_file_chunks(file_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Читает файл блоками в отдельном потоке, чтобы не блокировать event loop"""
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+async def track_upload_progress(chunks, progress=None, total: Optional[int] = None):
+    """Пропускает блоки насквозь, сообщая колбэку progress(отправлено, всего)"""
+    sent = 0
+    async for chunk in chunks:
+        yield chunk
+        sent += len(chunk)
+        if progress:
+            await progress(sent, total)
+
+class TokenBucket:
+    """Token bucket с пополнением rate токенов в секунду и возможностью паузы после FloodWait"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        delay = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return delay
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class TelegramSender:
+    """
+    Планировщик всех исходящих запросов бота к Telegram. Запросы проходят через
+    общий token bucket и bucket своего чата; ответы на callback-запросы обслуживаются
+    первыми и не расходуют лимит чата. При FloodWait чат ставится на паузу, а запрос
+    возвращается в очередь и повторяется без участия обработчика
+    """
+
+    PRIORITY_CALLBACK = 0
+    PRIORITY_MESSAGE = 1
+    PRIORITY_PROGRESS = 2
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._queue = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.flood_waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for request in self._queue:
+            request["future"].cancel()
+        self._queue.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._queue),
+            "sent": self.sent,
+            "flood_waits": self.flood_waits,
+            "avg_wait": round(self.total_wait / self.sent, 3) if self.sent else 0.0,
+            "max_wait": round(self.max_wait, 3),
+        }
+
+    async def call(self, chat_id: Optional[int], request_factory, priority: int = PRIORITY_MESSAGE):
+        """
+        Выполняет запрос в порядке очереди. request_factory - функция без аргументов,
+        возвращающая корутину вызова Pyrogram; результат вызова возвращается обработчику
+        """
+        if self._task is None:
+            return await request_factory()
+        self._seq += 1
+        request = {
+            "priority": priority,
+            "seq": self._seq,
+            "chat_id": chat_id,
+            "factory": request_factory,
+            "future": asyncio.get_running_loop().create_future(),
+            "enqueued_at": time.monotonic(),
+            "attempts": 0,
+        }
+        self._queue.append(request)
+        self._wakeup.set()
+        return await request["future"]
+
+    async def reply(self, message: Message, *args, **kwargs) -> Message:
+        return await self.call(message.chat.id, lambda: message.reply(*args, **kwargs))
+
+    async def reply_document(self, message: Message, *args, **kwargs) -> Message:
+        return await self.call(message.chat.id, lambda: message.reply_document(*args, **kwargs))
+
+    async def edit(self, message: Message, *args, priority: int = PRIORITY_MESSAGE, **kwargs) -> Message:
+        return await self.call(message.chat.id, lambda: message.edit_text(*args, **kwargs), priority)
+
+    async def answer(self, callback_query, *args, **kwargs):
+        return await self.call(None, lambda: callback_query.answer(*args, **kwargs), self.PRIORITY_CALLBACK)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self._chats) > TELEGRAM_CHAT_BUCKETS_LIMIT:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _next_request(self, now: float) -> Tuple[Optional[dict], Optional[float]]:
+        """Выбирает самый приоритетный запрос, чат которого готов к отправке"""
+        best = None
+        next_ready = None
+        for request in self._queue:
+            if request["future"].done():
+                continue
+            if request["chat_id"] is not None:
+                delay = self._chat_bucket(request["chat_id"]).wait_time(now)
+                if delay > 0:
+                    next_ready = delay if next_ready is None else min(next_ready, delay)
+                    continue
+            if best is None or (request["priority"], request["seq"]) < (best["priority"], best["seq"]):
+                best = request
+        return best, next_ready
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            self._queue = [request for request in self._queue if not request["future"].done()]
+            timeout = None
+            while self._queue:
+                now = time.monotonic()
+                global_delay = self._global.wait_time(now)
+                if global_delay > 0:
+                    timeout = global_delay
+                    break
+                request, next_ready = self._next_request(now)
+                if request is None:
+                    timeout = next_ready
+                    break
+                self._queue.remove(request)
+                self._global.take()
+                if request["chat_id"] is not None:
+                    self._chat_bucket(request["chat_id"]).take()
+                asyncio.create_task(self._dispatch(request))
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, request: dict) -> None:
+        future = request["future"]
+        try:
+            result = await request["factory"]()
+        except FloodWait as e:
+            self.flood_waits += 1
+            request["attempts"] += 1
+            logger.warning(f"FloodWait {e.value}с от Telegram (чат {request['chat_id']}, попытка {request['attempts']})")
+            if request["chat_id"] is not None:
+                self._chat_bucket(request["chat_id"]).block(e.value)
+            else:
+                self._global.block(e.value)
+            if request["attempts"] >= TELEGRAM_FLOOD_MAX_RETRIES:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            self._queue.append(request)
+            self._wakeup.set()
+            return
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        wait = time.monotonic() - request["enqueued_at"]
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if not future.done():
+            future.set_result(result)
+
+telegram_sender = TelegramSender()
+
+class ProgressReporter:
+    """
+    Единая точка обновления статусных сообщений. Задания только сообщают новый
+    текст; сервис отбрасывает повторы, для каждого сообщения отправляет лишь
+    последний текст, выдерживает интервал PROGRESS_EDIT_INTERVAL между правками
+    в одном чате и сам переживает FloodWait, не прерывая задание
+    """
+
+    def __init__(self, interval: float = PROGRESS_EDIT_INTERVAL):
+        self.interval = interval
+        self._pending: "OrderedDict[Tuple[int, int], Tuple[Message, str]]" = OrderedDict()
+        self._sent: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+        self._chat_ready_at: Dict[int, float] = {}
+        self._in_flight = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.flood_waits = 0
+        self.skipped = 0
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def report(self, message: Message, text: str) -> None:
+        """Запоминает новый текст статуса; сообщение будет отредактировано позже"""
+        key = (message.chat.id, message.id)
+        if key in self._pending:
+            self.skipped += 1
+        elif self._sent.get(key) == text:
+            self.skipped += 1
+            return
+        self._pending[key] = (message, text)
+        self._wakeup.set()
+
+    def discard(self, message: Message) -> None:
+        """Отменяет ожидающее обновление перед прямым редактированием сообщения"""
+        self._pending.pop((message.chat.id, message.id), None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self._pending), "skipped": self.skipped, "flood_waits": self.flood_waits}
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_ready = None
+            for key in list(self._pending):
+                if key in self._in_flight:
+                    continue
+                chat_id = key[0]
+                ready_at = self._chat_ready_at.get(chat_id, 0)
+                if ready_at > now:
+                    next_ready = ready_at if next_ready is None else min(next_ready, ready_at)
+                    continue
+                message, text = self._pending.pop(key)
+                self._chat_ready_at[chat_id] = now + self.interval
+                if self._sent.get(key) != text:
+                    self._in_flight.add(key)
+                    asyncio.create_task(self._deliver(key, message, text))
+
+            timeout = None if next_ready is None else max(0.0, next_ready - now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, key: Tuple[int, int], message: Message, text: str) -> None:
+        try:
+            await self._edit(key, message, text)
+        finally:
+            self._in_flight.discard(key)
+            self._wakeup.set()
+
+    async def _edit(self, key: Tuple[int, int], message: Message, text: str) -> None:
+        try:
+            await telegram_sender.edit(message, text, priority=TelegramSender.PRIORITY_PROGRESS)
+        except FloodWait as e:
+            self.flood_waits += 1
+            logger.warning(f"FloodWait {e.value}с при обновлении статуса в чате {key[0]}")
+            self._chat_ready_at[key[0]] = time.monotonic() + e.value
+            # Повторяем, только если за это время не появился более новый текст
+            self._pending.setdefault(key, (message, text))
+            return
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статусное сообщение: {e}")
+            return
+        self._sent[key] = text
+        self._sent.move_to_end(key)
+        while len(self._sent) > PROGRESS_SENT_HISTORY:
+            self._sent.popitem(last=False)
+
+progress_reporter = ProgressReporter()
+
+def make_upload_progress(status_msg: Message):
+    """Колбэк прогресса загрузки, обновляющий статусное сообщение не чаще UPLOAD_PROGRESS_INTERVAL"""
+    last_update = {"time": time.time()}
+
+    async def report(sent: int, total: Optional[int]) -> None:
+        now = time.time()
+        if now - last_update["time"] < UPLOAD_PROGRESS_INTERVAL:
+            return
+        last_update["time"] = now
+        sent_mb = sent / (1024 * 1024)
+        if total:
+            progress_reporter.report(status_msg, f"📤 Загружаю аудио... {sent_mb:.1f}/{total / (1024 * 1024):.1f} МБ ({sent * 100 // total}%)")
+        else:
+            progress_reporter.report(status_msg, f"📤 Загружаю аудио... {sent_mb:.1f} МБ")
+
+    return report
+
+assemblyai_client = AssemblyAIClient(ASSEMBLYAI_API_KEY, limiter=assemblyai_limiter)
+
+class TranscriptWebhookReceiver:
+    """Локальный приемник вебхуков AssemblyAI, будящий ожидающие задания"""
+
+    MAX_EARLY_EVENTS = 1000
+
+    def __init__(self, webhook_url: Optional[str], host: str, port: int, path: str, secret: Optional[str] = None):
+        self.webhook_url = webhook_url
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self._waiters: Dict[str, asyncio.Future] = {}
+        # Вебхук может прийти раньше, чем задание начнет его ждать
+        self._early_events: Dict[str, str] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.webhook_url)
+
+    async def start(self) -> None:
+        if not self.enabled or self._runner is not None:
+            return
+        web_app = web.Application()
+        web_app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(web_app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Приемник вебхуков AssemblyAI запущен на {self.host}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for future in self._waiters.values():
+            future.cancel()
+        self._waiters.clear()
+
+    def job_params(self) -> Dict[str, Any]:
+        """Параметры, которые нужно добавить к созданию задания транскрипции"""
+        if not self.enabled:
+            return {}
+        params = {"webhook_url": self.webhook_url}
+        if self.secret:
+            params["webhook_auth_header_name"] = WEBHOOK_AUTH_HEADER
+            params["webhook_auth_header_value"] = self.secret
+        return params
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get(WEBHOOK_AUTH_HEADER) != self.secret:
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+        except Exception:
+            return web.Response(status=400)
+
+        transcript_id = payload.get("transcript_id")
+        status = payload.get("status")
+        if not transcript_id or not status:
+            return web.Response(status=400)
+
+        logger.info(f"Получен вебхук AssemblyAI: {transcript_id} - {status}")
+        future = self._waiters.get(transcript_id)
+        if future is not None and not future.done():
+            future.set_result(status)
+        else:
+            if len(self._early_events) >= self.MAX_EARLY_EVENTS:
+                self._early_events.pop(next(iter(self._early_events)))
+            self._early_events[transcript_id] = status
+        return web.Response(text="ok")
+
+    async def wait(self, transcript_id: str, timeout: float) -> Optional[str]:
+        """Ждет вебхук по заданию; возвращает статус или None по таймауту"""
+        if transcript_id in self._early_events:
+            return self._early_events.pop(transcript_id)
+        future = self._waiters.get(transcript_id)
+        if future is None or future.done():
+            future = asyncio.get_running_loop().create_future()
+            self._waiters[transcript_id] = future
+        try:
+            status = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._waiters.pop(transcript_id, None)
+        return status
+
+    def discard(self, transcript_id: str) -> None:
+        future = self._waiters.pop(transcript_id, None)
+        if future is not None and not future.done():
+            future.cancel()
+        self._early_events.pop(transcript_id, None)
+
+webhook_receiver = TranscriptWebhookReceiver(
+    ASSEMBLYAI_WEBHOOK_URL,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    ASSEMBLYAI_WEBHOOK_SECRET
+)
+
+class TranscriptPollScheduler:
+    """
+    Единый планировщик опроса статусов всех активных транскрипций.
+    Первая проверка назначается по оценке времени обработки из длительности аудио,
+    дальше интервал растет экспоненциально. Все проверки, срок которых подошел,
+    выполняются одной пачкой из одной корутины.
+    """
+
+    def __init__(self, client: AssemblyAIClient):
+        self.client = client
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._queue = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for job in self._jobs.values():
+            job["future"].cancel()
+        self._jobs.clear()
+        self._queue.clear()
+
+    def track(self, transcript_id: str, audio_duration: float = 0, min_interval: float = POLL_MIN_INTERVAL) -> asyncio.Future:
+        """
+        Ставит задание на опрос. Future завершается кортежем (статус HTTP, ответ)
+        когда задание готово, упало или AssemblyAI вернул ошибку
+        """
+        estimate = audio_duration * TRANSCRIPTION_TIME_RATIO
+        first_delay = min(max(min_interval, estimate), POLL_MAX_INTERVAL)
+        job = {
+            "future": asyncio.get_running_loop().create_future(),
+            "interval": min_interval,
+            "errors": 0,
+        }
+        self._jobs[transcript_id] = job
+        self._schedule(transcript_id, first_delay)
+        logger.info(f"Опрос {transcript_id}: длительность {audio_duration:.0f}с, первая проверка через {first_delay:.0f}с")
+        return job["future"]
+
+    def check_now(self, transcript_id: str) -> None:
+        """Внеочередная проверка, например после вебхука"""
+        if transcript_id in self._jobs:
+            self._schedule(transcript_id, 0)
+
+    def untrack(self, transcript_id: str) -> None:
+        job = self._jobs.pop(transcript_id, None)
+        if job is not None and not job["future"].done():
+            job["future"].cancel()
+
+    def _schedule(self, transcript_id: str, delay: float) -> None:
+        heapq.heappush(self._queue, (time.monotonic() + delay, transcript_id))
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = set()
+            while self._queue and self._queue[0][0] <= now:
+                _, transcript_id = heapq.heappop(self._queue)
+                if transcript_id in self._jobs:
+                    due.add(transcript_id)
+
+            if due:
+                await asyncio.gather(*(self._check(transcript_id) for transcript_id in due))
+                continue
+
+            timeout = self._queue[0][0] - now if self._queue else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, transcript_id: str) -> None:
+        job = self._jobs.get(transcript_id)
+        if job is None:
+            return
+        try:
+            status_code, response_data = await self.client.get_transcript(transcript_id)
+        except Exception as e:
+            job["errors"] += 1
+            logger.warning(f"Ошибка при опросе {transcript_id} ({job['errors']}/{POLL_MAX_ERRORS}): {e}")
+            if job["errors"] >= POLL_MAX_ERRORS:
+                self._finish(transcript_id, exception=e)
+            else:
+                self._backoff(transcript_id, job)
+            return
+
+        if status_code != 200 or response_data.get("status") in ("completed", "error"):
+            self._finish(transcript_id, result=(status_code, response_data))
+        else:
+            job["errors"] = 0
+            self._backoff(transcript_id, job)
+
+    def _backoff(self, transcript_id: str, job: Dict[str, Any]) -> None:
+        self._schedule(transcript_id, job["interval"])
+        job["interval"] = min(job["interval"] * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+
+    def _finish(self, transcript_id: str, result: Any = None, exception: Exception = None) -> None:
+        job = self._jobs.pop(transcript_id, None)
+        if job is None or job["future"].done():
+            return
+        if exception is not None:
+            job["future"].set_exception(exception)
+        else:
+            job["future"].set_result(result)
+
+poll_scheduler = TranscriptPollScheduler(assemblyai_client)
+
+class MediaWorkerPool:
+    """Ограниченный пул для запуска ffmpeg/ffprobe через asyncio-подпроцессы"""
+
+    def __init__(self, size: int = MEDIA_WORKERS):
+        self.size = max(1, size)
+        self._semaphore = asyncio.Semaphore(self.size)
+        self.waiting = 0
+        self.active = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Количество задач, ожидающих свободного воркера"""
+        return self.waiting
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": self.size, "active": self.active, "queue_depth": self.waiting}
+
+    async def run(self, cmd) -> Tuple[int, bytes, bytes]:
+        """Запускает команду и возвращает (код возврата, stdout, stderr)"""
+        self.waiting += 1
+        if self._semaphore.locked():
+            logger.info(f"Медиа-задача ждет в очереди, глубина очереди: {self.waiting}")
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+            return process.returncode, stdout, stderr
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    async def stream(self, cmd, chunk_size: int = UPLOAD_CHUNK_SIZE, stdin_chunks=None):
+        """
+        Запускает команду и отдает ее stdout блоками по мере готовности.
+        Если передан stdin_chunks (асинхронный итератор байтов), он подается на stdin
+        """
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        process = None
+        feeder = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE if stdin_chunks is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            if stdin_chunks is not None:
+                feeder = asyncio.create_task(self._feed_stdin(process, stdin_chunks))
+            while True:
+                chunk = await process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            # Ошибка источника (например, оборванное скачивание) важнее кода ffmpeg
+            if feeder is not None:
+                await feeder
+            returncode = await process.wait()
+            if returncode != 0:
+                raise RuntimeError(f"ffmpeg завершился с кодом {returncode}")
+        finally:
+            if feeder is not None and not feeder.done():
+                feeder.cancel()
+                await asyncio.gather(feeder, return_exceptions=True)
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+            self.active -= 1
+            self._semaphore.release()
+
+    @staticmethod
+    async def _feed_stdin(process, chunks) -> None:
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg завершился раньше, чем прочитал весь вход - код возврата скажет остальное
+            pass
+        finally:
+            if not process.stdin.is_closing():
+                process.stdin.close()
+
+media_pool = MediaWorkerPool()
+
+def build_compress_cmd(input_path: str, output: str = "pipe:1"):
+    """Команда ffmpeg для перекодирования в MP3 64 кбит/с"""
+    return [
+        "ffmpeg",
+        "-i", input_path,
+        "-c:a", "libmp3lame",
+        "-b:a", "64k",
+        "-f", "mp3",
+        output
+    ]
+
+async def get_audio_duration(file_path):
     try:
         cmd = [
             "ffprobe",
@@ -132,16 +1379,174 @@ def get_audio_duration(file_path):
             "-of", "json",
             file_path
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        data = json.loads(result.stdout)
+        returncode, stdout, stderr = await media_pool.run(cmd)
+        data = json.loads(stdout)
         return float(data["format"]["duration"])
     except Exception as e:
         logger.error(f"Ошибка при получении длительности аудиофайла: {e}")
         return 0
 
+async def file_content_hash(file_path: str) -> str:
+    """SHA-256 содержимого файла, считается в отдельном потоке"""
+    def compute():
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    return await asyncio.to_thread(compute)
+
+class TextCache:
+    """
+    Файловый кэш текстов по ключу (транскрипции, ответы ChatGPT).
+    Записи старше ttl удаляются, при превышении max_bytes вытесняются
+    давно не использованные (время использования - mtime файла)
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(content_hash: str, language_code: str) -> str:
+        return f"{content_hash}_{language_code}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    async def get(self, key: str) -> Optional[str]:
+        text = await asyncio.to_thread(self._get_sync, key)
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    async def put(self, key: str, text: str) -> None:
+        await asyncio.to_thread(self._put_sync, key, text)
+
+    def _get_sync(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                text = json.load(f)["text"]
+            os.utime(path)
+            return text
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша {self.directory}: {e}")
+            return None
+
+    def _put_sync(self, key: str, text: str) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"text": text, "created": time.time()}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._evict()
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш {self.directory}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _evict(self) -> None:
+        now = time.time()
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+transcript_cache = TextCache(
+    TRANSCRIPT_CACHE_DIR,
+    int(TRANSCRIPT_CACHE_MAX_MB * 1024 * 1024),
+    TRANSCRIPT_CACHE_TTL
+)
+
+class FileIdIndex:
+    """
+    Индекс Telegram file_unique_id -> хэш содержимого. Позволяет найти
+    транскрипцию уже виденного файла, не скачивая его повторно
+    """
+
+    def __init__(self, path: str, max_entries: int = FILE_ID_INDEX_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка чтения индекса file_unique_id: {e}")
+
+    def get(self, file_unique_id: str) -> Optional[str]:
+        content_hash = self._entries.get(file_unique_id)
+        if content_hash is not None:
+            self._entries.move_to_end(file_unique_id)
+        return content_hash
+
+    async def put(self, file_unique_id: str, content_hash: str) -> None:
+        if self._entries.get(file_unique_id) == content_hash:
+            return
+        self._entries[file_unique_id] = content_hash
+        self._entries.move_to_end(file_unique_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        await asyncio.to_thread(self._save, dict(self._entries))
+
+    def _save(self, entries: Dict[str, str]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Ошибка записи индекса file_unique_id: {e}")
+
+file_id_index = FileIdIndex(FILE_ID_INDEX_PATH)
+
+gpt_cache = TextCache(
+    GPT_CACHE_DIR,
+    int(GPT_CACHE_MAX_MB * 1024 * 1024),
+    GPT_CACHE_TTL
+)
+
+def gpt_cache_key(model: str, prompt: str, text: str, **params) -> str:
+    """Ключ кэша ChatGPT: хэш модели, промпта, текста и параметров запроса"""
+    payload = json.dumps([model, prompt, text, params], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
 async def download_file(message: Message, file_id: str, save_path: str) -> Tuple[bool, str]:
     try:
-        status_msg = await message.reply("⏳ Скачиваю файл...")
+        status_msg = await telegram_sender.reply(message, "⏳ Скачиваю файл...")
         
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
         
@@ -149,151 +1554,288 @@ async def download_file(message: Message, file_id: str, save_path: str) -> Tuple
         
         # Проверка, что файл существует и не пустой
         if not os.path.exists(save_path) or os.path.getsize(save_path) == 0:
-            await status_msg.edit_text("❌ Ошибка: файл не скачался или пустой")
+            progress_reporter.report(status_msg, "❌ Ошибка: файл не скачался или пустой")
             return False, "Файл не скачался или пустой"
         
         file_size_mb = os.path.getsize(save_path) / (1024 * 1024)
         logger.info(f"Файл скачан: {save_path}, размер: {file_size_mb:.2f} МБ")
         
-        await status_msg.edit_text("✅ Файл успешно загружен. Выберите язык для транскрипции:")
+        progress_reporter.report(status_msg, "✅ Файл успешно загружен. Выберите язык для транскрипции:")
         
         return True, save_path
     
     except Exception as e:
         logger.error(f"Ошибка при скачивании файла: {e}", exc_info=True)
         try:
-            await status_msg.edit_text(f"❌ Ошибка при скачивании файла: {str(e)}")
+            progress_reporter.report(status_msg, f"❌ Ошибка при скачивании файла: {str(e)}")
         except:
-            await message.reply(f"❌ Ошибка при скачивании файла: {str(e)}")
+            await telegram_sender.reply(message, f"❌ Ошибка при скачивании файла: {str(e)}")
         return False, str(e)
 
-async def transcribe_with_assemblyai(audio_path: str, message: Message, status_msg: Message = None, target_language: str = "auto") -> Tuple[bool, str]:
+class MediaDownload:
+    """
+    Скачивание файла из Telegram через app.stream_media. Блоки записываются на диск
+    и сразу хэшируются, а читатели chunks() получают их по мере поступления, не дожидаясь
+    конца скачивания. Файл на диске нужен для повторных попыток загрузки и ffprobe
+    """
+
+    def __init__(self, file_id: str, save_path: str, total: Optional[int] = None, status_msg: Message = None):
+        self.file_id = file_id
+        self.path = save_path
+        self.total = total
+        self.status_msg = status_msg
+        self.written = 0
+        self.finished = False
+        self.error: Optional[Exception] = None
+        self.content_hash: Optional[str] = None
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def streamable(self) -> bool:
+        """Можно ли отдавать файл потребителям до окончания скачивания"""
+        return not self.finished and not self.path.lower().endswith(PIPELINE_SEEKABLE_EXTENSIONS)
+
+    def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Файл создается сразу, чтобы читатели могли открыть его до первого блока
+        open(self.path, "wb").close()
+        self._task = asyncio.create_task(self._run())
+
+    def add_done_callback(self, callback) -> None:
+        self._task.add_done_callback(callback)
+
+    def cancel(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def wait(self) -> Tuple[bool, str]:
+        """Дожидается конца скачивания, возвращает (успех, путь или текст ошибки)"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.finished)
+        if self.error is not None:
+            return False, str(self.error)
+        return True, self.path
+
+    async def chunks(self, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        """Читает файл с начала, догоняя скачивание; каждый вызов - новый независимый читатель"""
+        offset = 0
+        with open(self.path, "rb") as f:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.written > offset or self.finished)
+                    if self.error is not None:
+                        raise RuntimeError(f"Скачивание файла прервано: {self.error}")
+                    available = self.written - offset
+                if available == 0:
+                    break
+                chunk = await asyncio.to_thread(f.read, min(chunk_size, available))
+                offset += len(chunk)
+                yield chunk
+
+    async def _run(self) -> None:
+        digest = hashlib.sha256()
+
+        try:
+            with open(self.path, "ab") as f:
+                def consume(chunk: bytes) -> None:
+                    f.write(chunk)
+                    f.flush()
+                    digest.update(chunk)
+
+                async for chunk in app.stream_media(self.file_id):
+                    await asyncio.to_thread(consume, chunk)
+                    async with self._changed:
+                        self.written += len(chunk)
+                        self._changed.notify_all()
+                    if self.status_msg:
+                        self._report_progress()
+
+            if self.written == 0:
+                raise RuntimeError("Файл не скачался или пустой")
+            self.content_hash = digest.hexdigest()
+            logger.info(f"Файл скачан потоком: {self.path}, размер: {self.written / (1024 * 1024):.2f} МБ")
+            if self.status_msg:
+                progress_reporter.report(self.status_msg, "✅ Файл успешно загружен")
+        except asyncio.CancelledError:
+            self.error = RuntimeError("скачивание отменено")
+        except Exception as e:
+            logger.error(f"Ошибка при потоковом скачивании файла: {e}", exc_info=True)
+            self.error = e
+            if self.status_msg:
+                progress_reporter.report(self.status_msg, f"❌ Ошибка при скачивании файла: {str(e)}")
+        finally:
+            async with self._changed:
+                self.finished = True
+                self._changed.notify_all()
+
+    def _report_progress(self) -> None:
+        written_mb = self.written / (1024 * 1024)
+        if self.total:
+            text = f"⏳ Скачиваю файл... {written_mb:.1f}/{self.total / (1024 * 1024):.1f} МБ ({self.written * 100 // self.total}%)"
+        else:
+            text = f"⏳ Скачиваю файл... {written_mb:.1f} МБ"
+        progress_reporter.report(self.status_msg, text)
+
+# Незавершенные и еще не использованные потоковые скачивания по пути файла
+media_downloads: Dict[str, MediaDownload] = {}
+
+def discard_media_download(file_path: Optional[str]) -> None:
+    """Отменяет скачивание и забывает о нем"""
+    download = media_downloads.pop(file_path, None) if file_path else None
+    if download is not None:
+        download.cancel()
+
+async def transcribe_with_assemblyai(audio_path: str, message: Message, status_msg: Message = None, target_language: str = "auto",
+                                     source: Optional[MediaDownload] = None, duration: Optional[float] = None) -> Tuple[bool, str]:
     """
-    Транскрибация аудио с помощью AssemblyAI API
+    Транскрибация аудио с помощью AssemblyAI API. Если передан source - еще идущее
+    скачивание, аудио отправляется в ffmpeg или загрузку по мере поступления байтов
     """
+    transcript_id = None
     try:
         if status_msg:
-            await status_msg.edit_text("🔄 Отправка аудио на транскрипцию...")
+            progress_reporter.report(status_msg, "🔄 Отправка аудио на транскрипцию...")
         else:
-            status_msg = await message.reply("🔄 Отправка аудио на транскрипцию...")
+            status_msg = await telegram_sender.reply(message, "🔄 Отправка аудио на транскрипцию...")
         
         start_time = time.time()
         
-        file_size = os.path.getsize(audio_path)
-        file_size_mb = file_size / (1024 * 1024)
-        
-        if file_size > 20 * 1024 * 1024:
-            await status_msg.edit_text(f"⚙️ Файл слишком большой ({file_size_mb:.2f} МБ). Оптимизирую...")
-            compressed_path = os.path.join(AUDIO_FILES_DIR, f"{uuid.uuid4()}.mp3")
+        if source is not None and source.streamable:
+            # Telegram и AssemblyAI работают одновременно: ffprobe по неполному файлу
+            # невозможен, поэтому длительность берется из метаданных сообщения
+            file_size = source.total or 0
+            audio_duration = duration or 0
             
-            compress_cmd = [
-                "ffmpeg",
-                "-i", audio_path,
-                "-c:a", "libmp3lame",
-                "-b:a", "64k",
-                compressed_path
-            ]
+            if file_size > COMPRESS_THRESHOLD:
+                progress_reporter.report(status_msg, f"⚙️ Файл слишком большой ({file_size / (1024 * 1024):.2f} МБ). Оптимизирую и отправляю по мере скачивания...")
+                status_code, response_data = await assemblyai_client.upload_stream(
+                    lambda: media_pool.stream(build_compress_cmd("pipe:0"), stdin_chunks=source.chunks()),
+                    make_upload_progress(status_msg)
+                )
+            else:
+                status_code, response_data = await assemblyai_client.upload_stream(
+                    source.chunks,
+                    make_upload_progress(status_msg),
+                    file_size or None
+                )
+        else:
+            if source is not None:
+                downloaded, result = await source.wait()
+                if not downloaded:
+                    progress_reporter.report(status_msg, f"❌ Ошибка при скачивании файла: {result}")
+                    return False, f"Ошибка при скачивании файла: {result}"
             
-            result = subprocess.run(compress_cmd, capture_output=True, text=True)
+            file_size = os.path.getsize(audio_path)
+            file_size_mb = file_size / (1024 * 1024)
+            audio_duration = await get_audio_duration(audio_path)
+        
+            if file_size > COMPRESS_THRESHOLD and STREAMING_TRANSCODE:
+                progress_reporter.report(status_msg, f"⚙️ Файл слишком большой ({file_size_mb:.2f} МБ). Оптимизирую и отправляю на транскрипцию...")
+                status_code, response_data = await assemblyai_client.upload_stream(
+                    lambda: media_pool.stream(build_compress_cmd(audio_path)),
+                    make_upload_progress(status_msg)
+                )
+            else:
+                if file_size > COMPRESS_THRESHOLD:
+                    progress_reporter.report(status_msg, f"⚙️ Файл слишком большой ({file_size_mb:.2f} МБ). Оптимизирую...")
+                    compressed_path = os.path.join(AUDIO_FILES_DIR, f"{uuid.uuid4()}.mp3")
+                
+                    returncode, _, stderr = await media_pool.run(build_compress_cmd(audio_path, compressed_path))
+                    if returncode != 0:
+                        logger.error(f"Ошибка ffmpeg при сжатии: {stderr.decode(errors='replace')[-500:]}")
+                
+                    if os.path.exists(compressed_path) and os.path.getsize(compressed_path) > 0:
+                        compressed_size_mb = os.path.getsize(compressed_path) / (1024 * 1024)
+                        logger.info(f"Файл сжат до {compressed_size_mb:.2f} МБ")
+                        audio_path = compressed_path
+                        progress_reporter.report(status_msg, f"✅ Файл оптимизирован ({compressed_size_mb:.2f} МБ). Отправляю на транскрипцию...")
             
-            if os.path.exists(compressed_path) and os.path.getsize(compressed_path) > 0:
-                compressed_size_mb = os.path.getsize(compressed_path) / (1024 * 1024)
-                logger.info(f"Файл сжат до {compressed_size_mb:.2f} МБ")
-                audio_path = compressed_path
-                await status_msg.edit_text(f"✅ Файл оптимизирован ({compressed_size_mb:.2f} МБ). Отправляю на транскрипцию...")
-        
-        headers = {
-            "authorization": ASSEMBLYAI_API_KEY,
-            "content-type": "application/json"
-        }
+                status_code, response_data = await assemblyai_client.upload(audio_path, make_upload_progress(status_msg))
         
-        with open(audio_path, "rb") as f:
-            response = requests.post(
-                "https://api.assemblyai.com/v2/upload",
-                headers=headers,
-                data=f,
-                timeout=300
-            )
-        
-        if response.status_code != 200:
-            logger.error(f"Ошибка загрузки файла: {response.text}")
-            await status_msg.edit_text(f"❌ Ошибка при загрузке файла: {response.text}")
-            return False, f"Ошибка при загрузке файла: {response.text}"
+        if status_code != 200:
+            logger.error(f"Ошибка загрузки файла: {response_data}")
+            progress_reporter.report(status_msg, f"❌ Ошибка при загрузке файла: {response_data}")
+            return False, f"Ошибка при загрузке файла: {response_data}"
             
-        upload_url = response.json()["upload_url"]
+        upload_url = response_data["upload_url"]
         logger.info(f"Файл успешно загружен, URL: {upload_url}")
    
         target_lang_name = SUPPORTED_LANGUAGES.get(target_language, target_language)
-        await status_msg.edit_text(f"⏳ Файл загружен. Начинаю транскрипцию на {target_lang_name}...")
+        progress_reporter.report(status_msg, f"⏳ Файл загружен. Начинаю транскрипцию на {target_lang_name}...")
         
         data = {"audio_url": upload_url}
         
         data["language_code"] = target_language
+        data.update(webhook_receiver.job_params())
         
-        response = requests.post(
-            "https://api.assemblyai.com/v2/transcript",
-            json=data,
-            headers=headers
-        )
+        status_code, response_data = await assemblyai_client.create_transcript(data)
         
-        if response.status_code != 200:
-            logger.error(f"Ошибка создания задания: {response.text}")
-            await status_msg.edit_text(f"❌ Ошибка создания задания транскрипции: {response.text}")
-            return False, f"Ошибка создания задания: {response.text}"
+        if status_code != 200:
+            logger.error(f"Ошибка создания задания: {response_data}")
+            progress_reporter.report(status_msg, f"❌ Ошибка создания задания транскрипции: {response_data}")
+            return False, f"Ошибка создания задания: {response_data}"
         
-        transcript_id = response.json()["id"]
+        transcript_id = response_data["id"]
         logger.info(f"ID транскрипции: {transcript_id}")
         
-        last_update_time = time.time()
+        # В режиме вебхуков опрос нужен только как страховка
+        min_interval = WEBHOOK_FALLBACK_POLL_INTERVAL if webhook_receiver.enabled else POLL_MIN_INTERVAL
+        result_future = poll_scheduler.track(transcript_id, audio_duration, min_interval)
         
-        while True:
-            current_time = time.time()
-            # Обновляем статус каждые 10 секунд
-            if current_time - last_update_time >= 10:
-                elapsed_time = current_time - start_time
-                await status_msg.edit_text(f"⏳ Транскрибирую аудио... ({elapsed_time:.0f}с)")
-                last_update_time = current_time
+        while not result_future.done():
+            if webhook_receiver.enabled:
+                if await webhook_receiver.wait(transcript_id, 10):
+                    poll_scheduler.check_now(transcript_id)
+                    await asyncio.wait({result_future}, timeout=10)
+            else:
+                await asyncio.wait({result_future}, timeout=10)
             
-            response = requests.get(
-                f"https://api.assemblyai.com/v2/transcript/{transcript_id}",
-                headers=headers
-            )
+            # Обновляем статус каждые 10 секунд
+            if not result_future.done():
+                elapsed_time = time.time() - start_time
+                progress_reporter.report(status_msg, f"⏳ Транскрибирую аудио... ({elapsed_time:.0f}с)")
+        
+        status_code, response_data = result_future.result()
+        
+        if status_code != 200:
+            logger.error(f"Ошибка при проверке статуса: {response_data}")
+            progress_reporter.report(status_msg, f"❌ Ошибка при проверке статуса транскрипции: {response_data}")
+            return False, f"Ошибка при проверке статуса: {response_data}"
+        
+        status = response_data["status"]
+        
+        if status == "completed":
+            detected_language = response_data.get("language_code", "неизвестен")
+            detected_lang_name = SUPPORTED_LANGUAGES.get(detected_language, detected_language)
             
-            if response.status_code != 200:
-                logger.error(f"Ошибка при проверке статуса: {response.text}")
-                await status_msg.edit_text(f"❌ Ошибка при проверке статуса транскрипции: {response.text}")
-                return False, f"Ошибка при проверке статуса: {response.text}"
+            transcription_text = response_data["text"]
             
-            status = response.json()["status"]
+            progress_reporter.report(status_msg, f"✅ Транскрипция завершена!\n"
+                                    f"👂 Исходный язык аудио: {detected_lang_name}")
             
-            if status == "completed":
-                detected_language = response.json().get("language_code", "неизвестен")
-                detected_lang_name = SUPPORTED_LANGUAGES.get(detected_language, detected_language)
-                
-                transcription_text = response.json()["text"]
-                
-                await status_msg.edit_text(f"✅ Транскрипция завершена!\n"
-                                        f"👂 Исходный язык аудио: {detected_lang_name}")
-                
-                return True, transcription_text
-                
-            elif status == "error":
-                error_msg = response.json().get("error", "Неизвестная ошибка")
-                logger.error(f"Ошибка транскрипции: {error_msg}")
-                await status_msg.edit_text(f"❌ Ошибка при транскрипции: {error_msg}")
-                return False, f"Ошибка транскрипции: {error_msg}"
+            return True, transcription_text
             
-            await asyncio.sleep(3)
+        elif status == "error":
+            error_msg = response_data.get("error", "Неизвестная ошибка")
+            logger.error(f"Ошибка транскрипции: {error_msg}")
+            progress_reporter.report(status_msg, f"❌ Ошибка при транскрипции: {error_msg}")
+            return False, f"Ошибка транскрипции: {error_msg}"
     
     except Exception as e:
         logger.error(f"Ошибка при транскрипции: {e}", exc_info=True)
         if status_msg:
-            await status_msg.edit_text(f"❌ Произошла ошибка: {str(e)}")
+            progress_reporter.report(status_msg, f"❌ Произошла ошибка: {str(e)}")
         else:
-            await message.reply(f"❌ Произошла ошибка: {str(e)}")
+            await telegram_sender.reply(message, f"❌ Произошла ошибка: {str(e)}")
         return False, f"Ошибка при транскрипции: {str(e)}"
     
     finally:
+        if transcript_id:
+            poll_scheduler.untrack(transcript_id)
+            webhook_receiver.discard(transcript_id)
+        if source is not None:
+            source.cancel()
         try:
             if os.path.exists(audio_path):
                 os.remove(audio_path)
@@ -301,32 +1843,421 @@ async def transcribe_with_assemblyai(audio_path: str, message: Message, status_m
         except Exception as e:
             logger.error(f"Ошибка при удалении файла: {e}")
 
-async def process_with_chatgpt(text, prompt, message):
+class TranscriptionQueue:
+    """
+    Глобальная очередь заданий транскрипции с ограниченным числом воркеров.
+    Задания выдаются по кругу между пользователями, поэтому пачка файлов
+    от одного пользователя не задерживает остальных
+    """
+
+    def __init__(self, workers: int = TRANSCRIPTION_WORKERS):
+        self.workers = max(1, workers)
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._available = asyncio.Semaphore(0)
+        self._tasks = []
+        self.active = 0
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for queue in self._queues.values():
+            for job in queue:
+                job["future"].cancel()
+        self._queues.clear()
+
+    @property
+    def size(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, int]:
+        return {"workers": self.workers, "active": self.active, "queued": self.size}
+
+    def submit(self, username: str, job_factory, on_position=None) -> asyncio.Future:
+        """
+        Ставит задание в очередь. job_factory - функция без аргументов,
+        возвращающая корутину; on_position(позиция) вызывается при изменении места в очереди
+        """
+        job = {
+            "factory": job_factory,
+            "future": asyncio.get_running_loop().create_future(),
+            "on_position": on_position,
+            "position": None,
+        }
+        self._queues.setdefault(username, deque()).append(job)
+        self._available.release()
+        self._update_positions()
+        return job["future"]
+
+    def _ordered_jobs(self):
+        """Задания в порядке, в котором их выдаст круговой обход"""
+        queues = [list(queue) for queue in self._queues.values()]
+        ordered = []
+        for i in range(max((len(queue) for queue in queues), default=0)):
+            ordered.extend(queue[i] for queue in queues if i < len(queue))
+        return ordered
+
+    def _update_positions(self) -> None:
+        # Пока есть свободные воркеры, задания не ждут и позицию сообщать незачем
+        if self.active < self.workers:
+            return
+        for position, job in enumerate(self._ordered_jobs(), start=1):
+            if job["position"] != position:
+                job["position"] = position
+                if job["on_position"]:
+                    asyncio.create_task(self._notify(job, position))
+
+    async def _notify(self, job: Dict[str, Any], position: int) -> None:
+        if job["position"] != position:
+            return
+        try:
+            await job["on_position"](position)
+        except Exception as e:
+            logger.warning(f"Не удалось сообщить позицию в очереди: {e}")
+
+    def _next_job(self) -> Dict[str, Any]:
+        username, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        if queue:
+            self._queues.move_to_end(username)
+        else:
+            del self._queues[username]
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            await self._available.acquire()
+            job = self._next_job()
+            job["position"] = 0
+            if job["future"].done():
+                continue
+
+            self.active += 1
+            self._update_positions()
+            try:
+                result = await job["factory"]()
+                if not job["future"].done():
+                    job["future"].set_result(result)
+            except asyncio.CancelledError:
+                job["future"].cancel()
+                raise
+            except Exception as e:
+                if not job["future"].done():
+                    job["future"].set_exception(e)
+            finally:
+                self.active -= 1
+
+transcription_queue = TranscriptionQueue()
+
+_encodings = {}
+
+def get_encoding(model: str = GPT_MODEL):
+    """Токенизатор tiktoken для модели или None, если tiktoken не установлен"""
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+def estimate_tokens(text: str, model: str = GPT_MODEL) -> int:
+    """Число токенов по токенизатору модели; без tiktoken - грубая оценка по символам"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, limit: int, model: str = GPT_MODEL) -> str:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:limit * 3]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:limit])
+
+def classify_prompt(prompt: str) -> str:
+    """Класс промпта для маршрутизации: summary (краткий ответ) или general"""
+    return "summary" if SUMMARY_PROMPT_RE.search(prompt) else "general"
+
+def select_gpt_route(text_tokens: int, prompt: str) -> Dict[str, Any]:
+    prompt_class = classify_prompt(prompt)
+    for route in GPT_ROUTES:
+        if route.get("prompt_class") not in (None, prompt_class):
+            continue
+        if route.get("max_input_tokens") is None or text_tokens <= route["max_input_tokens"]:
+            return route
+    return {"name": "default", "model": GPT_MODEL, "max_tokens": GPT_MAX_TOKENS}
+
+class GPTRouteStats:
+    """Статистика задержек по маршрутам ChatGPT"""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, route_name: str, latency: float) -> None:
+        stats = self._stats.setdefault(route_name, {"count": 0, "total_latency": 0.0, "max_latency": 0.0})
+        stats["count"] += 1
+        stats["total_latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: {
+                "count": stats["count"],
+                "avg_latency": round(stats["total_latency"] / stats["count"], 2),
+                "max_latency": round(stats["max_latency"], 2),
+            }
+            for name, stats in self._stats.items()
+        }
+
+gpt_route_stats = GPTRouteStats()
+
+def plan_gpt_request(text: str, prompt: str) -> Dict[str, Any]:
+    """
+    Выбирает маршрут (модель и max_tokens), оценивает размер запроса до отправки
+    и выбирает стратегию: direct - один запрос, chunk - обработка по частям,
+    truncate - текст обрезается до GPT_MAX_INPUT_TOKENS и обрабатывается по частям
+    """
+    text_tokens = estimate_tokens(text)
+    route = select_gpt_route(text_tokens, prompt)
+    model = route["model"]
+    max_tokens = route["max_tokens"]
+    prompt_tokens = estimate_tokens(prompt, model) + GPT_MESSAGE_OVERHEAD_TOKENS
+    context_tokens = GPT_CONTEXT_TOKENS.get(model, 4096)
+
+    if prompt_tokens + text_tokens + max_tokens <= context_tokens:
+        strategy = "direct"
+        chunks = 1
+    else:
+        strategy = "chunk" if text_tokens <= GPT_MAX_INPUT_TOKENS else "truncate"
+        chunks = -(-min(text_tokens, GPT_MAX_INPUT_TOKENS) // GPT_CHUNK_TOKENS)
+
+    # Для map-reduce: каждая часть плюс финальное объединение
+    requests_count = chunks + 1 if chunks > 1 else 1
+    return {
+        "route": route["name"],
+        "model": model,
+        "max_tokens": max_tokens,
+        "strategy": strategy,
+        "text_tokens": text_tokens,
+        "input_tokens": text_tokens + prompt_tokens * requests_count,
+        "output_tokens": max_tokens * requests_count,
+        "chunks": chunks,
+    }
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s+")
+
+def split_text_by_tokens(text: str, budget: int):
+    """Делит текст на части не длиннее budget токенов по границам предложений"""
+    pieces = []
+    for sentence in SENTENCE_END_RE.split(text):
+        if estimate_tokens(sentence) <= budget:
+            pieces.append(sentence)
+            continue
+        # Слишком длинное "предложение" (например, без знаков препинания) режем по словам
+        words = []
+        words_tokens = 0
+        for word in sentence.split():
+            word_tokens = estimate_tokens(" " + word)
+            if words and words_tokens + word_tokens > budget:
+                pieces.append(" ".join(words))
+                words = []
+                words_tokens = 0
+            words.append(word)
+            words_tokens += word_tokens
+        if words:
+            pieces.append(" ".join(words))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens(piece)
+        if current and current_tokens + piece_tokens > budget:
+            chunks.append(" ".join(current))
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+async def openai_chat_create(**kwargs):
+    """
+    chat.completions.create через общий ограничитель OpenAI. После 429
+    запросы приостанавливаются на Retry-After с jitter, сетевые ошибки и 5xx
+    повторяются OPENAI_MAX_RETRIES раз с экспоненциальной паузой
+    """
+    text = "".join(
+        part["text"] for message in kwargs["messages"] for part in message["content"]
+    )
+    tokens = estimate_tokens(text, kwargs["model"]) + kwargs.get("max_tokens", 0)
+    rate_limit_retries = 0
+    error_retries = 0
+    while True:
+        await openai_limiter.acquire(tokens)
+        try:
+            return await openai_client.chat.completions.create(**kwargs)
+        except RateLimitError as e:
+            rate_limit_retries += 1
+            openai_limiter.penalize(parse_retry_after(e.response.headers if e.response is not None else None))
+            if rate_limit_retries > RATE_LIMIT_MAX_RETRIES:
+                raise
+        except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+            error_retries += 1
+            if error_retries > OPENAI_MAX_RETRIES:
+                raise
+            delay = 2 ** (error_retries - 1) + random.uniform(0, RATE_LIMIT_MAX_JITTER)
+            logger.warning(f"Ошибка OpenAI ({error_retries}/{OPENAI_MAX_RETRIES}), повтор через {delay:.1f}с: {e}")
+            await asyncio.sleep(delay)
+
+async def chat_completion(system_prompt: str, text: str, on_progress=None, model: str = GPT_MODEL, max_tokens: int = GPT_MAX_TOKENS) -> str:
+    """
+    Один запрос к ChatGPT. Если передан on_progress, ответ читается
+    потоком и колбэк получает накопленный текст не чаще GPT_STREAM_EDIT_INTERVAL
+    """
+    messages = [
+        {
+            "role": "system",
+            "content": [{"type": "text", "text": system_prompt}]
+        },
+        {
+            "role": "user",
+            "content": [{"type": "text", "text": text}]
+        }
+    ]
+    
+    if on_progress is None:
+        response = await openai_chat_create(
+            model=model,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content
+    
+    stream = await openai_chat_create(
+        model=model,
+        messages=messages,
+        temperature=0.7,
+        max_tokens=max_tokens,
+        stream=True
+    )
+    
+    parts = []
+    last_emit_time = 0
+    async for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        parts.append(chunk.choices[0].delta.content)
+        
+        current_time = time.monotonic()
+        if current_time - last_emit_time >= GPT_STREAM_EDIT_INTERVAL:
+            last_emit_time = current_time
+            try:
+                await on_progress("".join(parts))
+            except Exception as e:
+                logger.warning(f"Не удалось обновить промежуточный ответ: {e}")
+    
+    return "".join(parts)
+
+async def map_reduce_chatgpt(text: str, prompt: str, on_progress=None, on_status=None, model: str = GPT_MODEL, max_tokens: int = GPT_MAX_TOKENS) -> str:
+    """
+    Обработка текста, не помещающегося в контекст модели: части обрабатываются
+    параллельно (не более GPT_MAP_CONCURRENCY), затем результаты объединяются,
+    при необходимости в несколько уровней
+    """
+    semaphore = asyncio.Semaphore(GPT_MAP_CONCURRENCY)
+    level = 1
+    
+    while True:
+        chunks = split_text_by_tokens(text, GPT_CHUNK_TOKENS)
+        if len(chunks) == 1:
+            break
+        
+        logger.info(f"Map-reduce, уровень {level}: {len(chunks)} частей")
+        done = 0
+        
+        async def process_chunk(index: int, chunk: str) -> str:
+            nonlocal done
+            chunk_prompt = (
+                f"{prompt}\n\n"
+                f"Это часть {index + 1} из {len(chunks)} длинного текста. "
+                "Обработай только эту часть."
+            )
+            async with semaphore:
+                result = await chat_completion(chunk_prompt, chunk, model=model, max_tokens=max_tokens)
+            done += 1
+            if on_status:
+                try:
+                    await on_status(f"🧠 Текст длинный, обрабатываю по частям (уровень {level}): {done}/{len(chunks)}")
+                except Exception as e:
+                    logger.warning(f"Не удалось обновить статус обработки: {e}")
+            return result
+        
+        results = await asyncio.gather(*(process_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+        text = "\n\n".join(f"Часть {i + 1}:\n{result}" for i, result in enumerate(results))
+        level += 1
+    
+    if on_status:
+        try:
+            await on_status("🧠 Объединяю результаты обработки частей...")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус обработки: {e}")
+    
+    reduce_prompt = (
+        "Ниже приведены результаты обработки последовательных частей одного длинного текста. "
+        "Объедини их в один связный итоговый ответ, следуя исходной инструкции:\n\n"
+        f"{prompt}"
+    )
+    return await chat_completion(reduce_prompt, text, on_progress, model, max_tokens)
+
+async def process_with_chatgpt(text, prompt, message, on_progress=None, on_status=None):
+    """
+    Обработка текста через ChatGPT. Длинные тексты обрабатываются по частям,
+    on_status получает сообщения о ходе обработки частей
+    """
     try:
         if not openai_client:
             return False, "❌ Ошибка: API ключ OpenAI не настроен в конфигурации бота."
         
-        messages = [
-            {
-                "role": "system",
-                "content": [{"type": "text", "text": prompt}]
-            },
-            {
-                "role": "user",
-                "content": [{"type": "text", "text": text}]
-            }
-        ]
-        
-        logger.info(f"Отправляю запрос в OpenAI с новым форматом")
+        plan = await asyncio.to_thread(plan_gpt_request, text, prompt)
         
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
+        cache_key = gpt_cache_key(
+            plan["model"], prompt, text,
             temperature=0.7,
-            max_tokens=2000
+            max_tokens=plan["max_tokens"],
+            chunk_tokens=GPT_CHUNK_TOKENS
         )
+        cached_result = await gpt_cache.get(cache_key)
+        if cached_result is not None:
+            logger.info(f"Ответ ChatGPT взят из кэша, статистика: {gpt_cache.stats()}")
+            return True, cached_result
+        
+        logger.info(f"Отправляю запрос в OpenAI с новым форматом, маршрут: {plan['route']}, план: {plan['strategy']}")
         
-        result = response.choices[0].message.content
+        if plan["strategy"] == "truncate":
+            text = truncate_to_tokens(text, GPT_MAX_INPUT_TOKENS)
+        
+        start_time = time.monotonic()
+        if plan["strategy"] == "direct":
+            result = await chat_completion(prompt, text, on_progress, plan["model"], plan["max_tokens"])
+        else:
+            result = await map_reduce_chatgpt(text, prompt, on_progress, on_status, plan["model"], plan["max_tokens"])
+        
+        plan["latency"] = round(time.monotonic() - start_time, 2)
+        gpt_route_stats.record(plan["route"], plan["latency"])
+        plan["result_chars"] = len(result or "")
+        gpt_stats_logger.info(json.dumps(plan, ensure_ascii=False))
+        
+        if result:
+            await gpt_cache.put(cache_key, result)
 
         return True, result
     
@@ -351,17 +2282,20 @@ async def show_language_selection(message: Message, file_path: str) -> None:
         InlineKeyboardButton("🔙 Отмена", callback_data="cancel_transcription")
     ])
     
-    await message.reply(
+    await telegram_sender.reply(message,
         "Выберите язык для транскрипции:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
 def get_user_prompts(username):
     """Получить список предыдущих промптов пользователя"""
+    load_user_data(username)
     return user_prompts.get(username, [])
 
 def add_user_prompt(username, prompt):
     """Добавить новый промпт в историю пользователя"""
+    load_user_data(username)
+    mark_dirty(username)
     if username not in user_prompts:
         user_prompts[username] = []
     
@@ -382,16 +2316,21 @@ def add_user_prompt(username, prompt):
 
 def set_user_prompt(username, prompt):
     """Установить текущий промпт пользователя"""
+    load_user_data(username)
+    mark_dirty(username)
     user_current_prompts[username] = prompt
     # Также добавляем его в историю
     add_user_prompt(username, prompt)
 
 def get_current_prompt(username):
     """Получить текущий промпт пользователя"""
+    load_user_data(username)
     return user_current_prompts.get(username, "")
 
 def remove_user_prompt(username, index):
     """Удалить промпт пользователя по индексу"""
+    load_user_data(username)
+    mark_dirty(username)
     if username in user_prompts and 0 <= index < len(user_prompts[username]):
         removed_prompt = user_prompts[username].pop(index)
         if username in user_current_prompts and user_current_prompts[username] == removed_prompt:
@@ -409,31 +2348,94 @@ async def handle_language_selection(client, callback_query):
         language_code = callback_query.data.split("_")[1]
         
         username = callback_query.from_user.username or str(callback_query.from_user.id)
-        file_path = get_state(username).get("file_path")
-        
-        if not file_path or not os.path.exists(file_path):
-            await callback_query.answer("Файл не найден, загрузите файл заново")
+        state = get_state(username)
+        file_path = state.get("file_path")
+        content_hash = state.get("content_hash")
+        media = state.get("media") or {}
+        download = media_downloads.get(file_path) if file_path else None
+        
+        # Если файл уже встречался, его можно не скачивать: хэш известен по file_unique_id
+        if not content_hash and (not file_path or not os.path.exists(file_path)):
+            await telegram_sender.answer(callback_query, "Файл не найден, загрузите файл заново")
             return
         
         set_state(username, "language", language_code)
         
         lang_name = SUPPORTED_LANGUAGES.get(language_code, "оригинальный")
-        await callback_query.answer(f"Выбран язык: {lang_name}")
+        await telegram_sender.answer(callback_query, f"Выбран язык: {lang_name}")
         
-        status_msg = await callback_query.message.edit_text(
+        status_msg = await telegram_sender.edit(callback_query.message,
             f"🔤 Выбран язык: {lang_name}\n⏳ Начинаю транскрипцию...",
             reply_markup=None
         )
         
-        success, transcription = await transcribe_with_assemblyai(
-            file_path, 
-            callback_query.message, 
-            status_msg, 
-            language_code
-        )
+        # Одинаковые файлы (пересланные голосовые и т.п.) не транскрибируем повторно.
+        # Пока файл еще скачивается потоком, хэша нет и кэш проверить нельзя
+        if not content_hash:
+            if download is None:
+                content_hash = await file_content_hash(file_path)
+            elif download.finished:
+                content_hash = download.content_hash
+            if content_hash and media.get("file_unique_id"):
+                await file_id_index.put(media["file_unique_id"], content_hash)
+        if download is not None and download.finished and download.error is not None:
+            media_downloads.pop(file_path, None)
+            progress_reporter.report(status_msg, f"❌ Ошибка при скачивании файла: {download.error}")
+            clear_state(username)
+            return
+        cache_key = transcript_cache.make_key(content_hash, language_code) if content_hash else None
+        transcription = await transcript_cache.get(cache_key) if cache_key else None
+        
+        if transcription is not None:
+            success = True
+            logger.info(f"Транскрипция для {username} взята из кэша")
+            progress_reporter.report(status_msg, "✅ Транскрипция найдена в кэше!")
+            media_downloads.pop(file_path, None)
+            if file_path and os.path.exists(file_path):
+                try:
+                    os.remove(file_path)
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении файла: {e}")
+        else:
+            if not file_path or not os.path.exists(file_path):
+                # Файл не скачивался заранее - скачиваем только сейчас, когда кэш не помог
+                file_path = media["save_path"]
+                progress_reporter.report(status_msg, f"🔤 Выбран язык: {lang_name}\n⏳ Скачиваю файл...")
+                await app.download_media(message=media["file_id"], file_name=file_path)
+                if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+                    progress_reporter.report(status_msg, "❌ Ошибка: файл не скачался или пустой")
+                    clear_state(username)
+                    return
+            
+            async def report_position(position):
+                progress_reporter.report(status_msg, f"🔤 Выбран язык: {lang_name}\n🕒 Вы #{position} в очереди на транскрипцию...")
+            
+            success, transcription = await transcription_queue.submit(
+                username,
+                lambda: transcribe_with_assemblyai(
+                    file_path, 
+                    callback_query.message, 
+                    status_msg, 
+                    language_code,
+                    source=download,
+                    duration=media.get("duration")
+                ),
+                report_position
+            )
+            media_downloads.pop(file_path, None)
+            
+            if success and cache_key is None and download is not None and download.content_hash:
+                # Хэш посчитан по ходу потокового скачивания
+                content_hash = download.content_hash
+                cache_key = transcript_cache.make_key(content_hash, language_code)
+                if media.get("file_unique_id"):
+                    await file_id_index.put(media["file_unique_id"], content_hash)
+            
+            if success and cache_key:
+                await transcript_cache.put(cache_key, transcription)
         
         if success:
-            set_state(username, "transcription", transcription)
+            transcription_view.set_text(username, transcription)
             
             keyboard = [
                 [InlineKeyboardButton("📝 Показать транскрипцию", callback_data="show_transcription")],
@@ -441,128 +2443,248 @@ async def handle_language_selection(client, callback_query):
                 [InlineKeyboardButton("🔙 В главное меню", callback_data="back_to_menu")]
             ]
             
-            await callback_query.message.reply(
+            await telegram_sender.reply(callback_query.message,
                 "✅ Транскрипция завершена!\nВыберите действие с полученным текстом:",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
             
             logger.info(f"Транскрипция успешно получена для {username}, длина: {len(transcription)} символов")
         else:
-            await callback_query.message.reply(f"❌ Не удалось выполнить транскрипцию: {transcription}")
+            await telegram_sender.reply(callback_query.message, f"❌ Не удалось выполнить транскрипцию: {transcription}")
             
             clear_state(username)
                 
     except Exception as e:
         logger.error(f"Ошибка при обработке выбора языка: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
         username = callback_query.from_user.username or str(callback_query.from_user.id)
         clear_state(username)
 
-@app.on_callback_query(filters.regex(r"^show_transcription$"))
-async def show_transcription(client, callback_query):
-    try:
-        username = callback_query.from_user.username or str(callback_query.from_user.id)
-        
-        transcription = get_state(username).get("transcription")
-        
-        if not transcription:
-            await callback_query.answer("Транскрипция не найдена")
-            return
-        
-        page_size = 3000
-        pages = [transcription[i:i+page_size] for i in range(0, len(transcription), page_size)]
-        total_pages = len(pages)
-        
-        set_state(username, "pages", pages)
-        set_state(username, "current_page", 0)
+# Лимит Telegram на длину сообщения в UTF-16 единицах; часть оставляем под заголовок страницы
+TELEGRAM_MESSAGE_LIMIT = 4096
+PAGE_HEADER_RESERVE = 96
+PAGE_SIZE = TELEGRAM_MESSAGE_LIMIT - PAGE_HEADER_RESERVE
+# Граница страницы ищется не раньше этой доли от лимита, иначе режем по словам
+PAGE_MIN_FILL = 0.6
+# Тексты длиннее этого числа страниц отправляются одним файлом вместо листания
+DOCUMENT_PAGE_THRESHOLD = int(os.getenv("DOCUMENT_PAGE_THRESHOLD", "5"))
+
+PAGE_BREAK_RES = [
+    re.compile(r"\n\s*"),
+    re.compile(r"[.!?…]+[\"»)]?\s+"),
+    re.compile(r"\s+"),
+]
+MARKDOWN_MARKERS = ("```", "**", "__", "`")
+
+def utf16_len(text: str) -> int:
+    """Длина в UTF-16 единицах, как ее считает Telegram"""
+    return len(text.encode("utf-16-le")) // 2
+
+def _fit_utf16(text: str, start: int, limit: int) -> int:
+    """Самый дальний конец end, при котором text[start:end] не длиннее limit UTF-16 единиц"""
+    end = min(len(text), start + limit)
+    while True:
+        excess = utf16_len(text[start:end]) - limit
+        if excess <= 0:
+            return end
+        end -= excess
+
+def _unbalanced_marker_position(page: str) -> int:
+    """Позиция последнего незакрытого маркера Markdown на странице или -1"""
+    for marker in MARKDOWN_MARKERS:
+        if page.count(marker) % 2:
+            return page.rfind(marker)
+        page = page.replace(marker, " " * len(marker))
+    return -1
+
+def build_page_offsets(text: str, page_size: int = PAGE_SIZE):
+    """
+    Смещения начала страниц. Страница заполняется почти до лимита Telegram
+    (в UTF-16 единицах) и обрывается на границе абзаца, предложения или слова,
+    не разрывая разметку Markdown
+    """
+    offsets = [0]
+    start = 0
+    min_fill = int(page_size * PAGE_MIN_FILL)
+    while True:
+        end = _fit_utf16(text, start, page_size)
+        if end >= len(text):
+            return offsets
+        
+        window = text[start:end]
+        cut = None
+        for break_re in PAGE_BREAK_RES:
+            matches = [m for m in break_re.finditer(window, min_fill)]
+            if matches:
+                cut = matches[-1]
+                break
+        page_end = start + cut.start() if cut else end
+        next_start = start + cut.end() if cut else end
+        
+        marker_pos = _unbalanced_marker_position(text[start:page_end])
+        if marker_pos > 0:
+            page_end = next_start = start + marker_pos
+        
+        offsets.append(next_start)
+        start = next_start
+
+class PagedView:
+    """
+    Постраничный просмотр длинного текста. Текст хранится в состоянии пользователя
+    один раз, рядом - индекс смещений страниц; страница вырезается при показе
+    """
+
+    def __init__(self, text_key: str, index_key: str, page_key: str, callback_prefix: str, title: str, document_name: str):
+        self.document_name = document_name
+        self.text_key = text_key
+        self.index_key = index_key
+        self.page_key = page_key
+        self.prev_callback = f"prev_{callback_prefix}page"
+        self.next_callback = f"next_{callback_prefix}page"
+        self.info_callback = f"{callback_prefix}page_info"
+        self.title = title
+
+    def set_text(self, username: str, text: str) -> None:
+        set_state(username, self.text_key, text)
+        clear_state(username, self.index_key)
+        set_state(username, self.page_key, 0)
+
+    def get_offsets(self, username: str):
+        """Индекс страниц; строится один раз на текст"""
+        state = get_state(username)
+        text = state.get(self.text_key)
+        if not text:
+            return None
+        offsets = state.get(self.index_key)
+        if not offsets:
+            offsets = build_page_offsets(text)
+            set_state(username, self.index_key, offsets)
+        return offsets
+
+    def total_pages(self, username: str) -> int:
+        offsets = self.get_offsets(username)
+        return len(offsets) if offsets else 0
+
+    def current_page(self, username: str) -> int:
+        return get_state(username).get(self.page_key, 0)
+
+    def render(self, username: str, page: int) -> Tuple[str, InlineKeyboardMarkup]:
+        text = get_state(username)[self.text_key]
+        offsets = self.get_offsets(username)
+        total_pages = len(offsets)
+        end = offsets[page + 1] if page + 1 < total_pages else len(text)
         
         keyboard = []
-        
         if total_pages > 1:
-            nav_buttons = []
-            nav_buttons.append(InlineKeyboardButton("◀️", callback_data="prev_page"))
-            nav_buttons.append(InlineKeyboardButton(f"1/{total_pages}", callback_data="page_info"))
-            nav_buttons.append(InlineKeyboardButton("▶️", callback_data="next_page"))
-            keyboard.append(nav_buttons)
-        
+            keyboard.append([
+                InlineKeyboardButton("◀️", callback_data=self.prev_callback),
+                InlineKeyboardButton(f"{page + 1}/{total_pages}", callback_data=self.info_callback),
+                InlineKeyboardButton("▶️", callback_data=self.next_callback),
+            ])
         keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
         
-        await callback_query.message.edit_text(
-            f"📝 **Результат транскрипции** (страница 1/{total_pages}):\n\n{pages[0]}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        body = f"{self.title} (страница {page + 1}/{total_pages}):\n\n{text[offsets[page]:end].rstrip()}"
+        return body, InlineKeyboardMarkup(keyboard)
+
+    def should_send_document(self, username: str) -> bool:
+        return self.total_pages(username) > DOCUMENT_PAGE_THRESHOLD
+
+    async def send_document(self, message: Message, username: str) -> None:
+        """Отправляет весь текст одним файлом вместо постраничного просмотра"""
+        text = get_state(username)[self.text_key]
+        document = io.BytesIO(text.encode("utf-8"))
+        document.name = self.document_name
+        await telegram_sender.reply_document(message,
+            document,
+            caption=f"{self.title} ({len(text)} символов)",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
+            ])
         )
-        
-        await callback_query.answer("Показываю транскрипцию")
-        
-    except Exception as e:
-        logger.error(f"Ошибка при показе транскрипции: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
 
-@app.on_callback_query(filters.regex(r"^(prev|next)_page$"))
-async def navigate_pages(client, callback_query):
-    try:
+    async def navigate(self, callback_query) -> None:
+        """Обработка кнопок ◀️/▶️"""
         username = callback_query.from_user.username or str(callback_query.from_user.id)
         action = callback_query.data.split("_")[0]  # prev или next
         
-        # Получаем страницы и текущую страницу
-        pages = get_state(username).get("pages", [])
-        current_page = get_state(username).get("current_page", 0)
-        total_pages = len(pages)
+        total_pages = self.total_pages(username)
+        current_page = self.current_page(username)
         
-        if not pages:
-            await callback_query.answer("Информация о страницах не найдена")
+        if not total_pages:
+            await telegram_sender.answer(callback_query, "Информация о страницах не найдена")
             return
-            
+        
         if action == "prev":
-            if current_page > 0:
-                current_page -= 1
-                set_state(username, "current_page", current_page)
-            else:
-                await callback_query.answer("Вы уже на первой странице")
+            if current_page <= 0:
+                await telegram_sender.answer(callback_query, "Вы уже на первой странице")
                 return
+            current_page -= 1
         elif action == "next":
-            if current_page < total_pages - 1:
-                current_page += 1
-                set_state(username, "current_page", current_page)
-            else:
-                await callback_query.answer("Вы уже на последней странице")
+            if current_page >= total_pages - 1:
+                await telegram_sender.answer(callback_query, "Вы уже на последней странице")
                 return
-            
-        keyboard = []
+            current_page += 1
+        set_state(username, self.page_key, current_page)
         
-        if total_pages > 1:
-            nav_buttons = []
-            nav_buttons.append(InlineKeyboardButton("◀️", callback_data="prev_page"))
-            nav_buttons.append(InlineKeyboardButton(f"{current_page + 1}/{total_pages}", callback_data="page_info"))
-            nav_buttons.append(InlineKeyboardButton("▶️", callback_data="next_page"))
-            keyboard.append(nav_buttons)
+        body, reply_markup = self.render(username, current_page)
+        await telegram_sender.edit(callback_query.message, body, reply_markup=reply_markup)
+        await telegram_sender.answer(callback_query, f"Страница {current_page + 1} из {total_pages}")
+
+    async def page_info(self, callback_query) -> None:
+        username = callback_query.from_user.username or str(callback_query.from_user.id)
+        await telegram_sender.answer(callback_query, f"Страница {self.current_page(username) + 1} из {self.total_pages(username)}")
+
+transcription_view = PagedView(
+    "transcription", "page_offsets", "current_page", "",
+    "📝 **Результат транскрипции**",
+    "transcription.txt"
+)
+gpt_view = PagedView(
+    "gpt_result", "gpt_page_offsets", "current_gpt_page", "gpt_",
+    "🧠 **Результат обработки ChatGPT**",
+    "chatgpt_result.md"
+)
+
+@app.on_callback_query(filters.regex(r"^show_transcription$"))
+async def show_transcription(client, callback_query):
+    try:
+        username = callback_query.from_user.username or str(callback_query.from_user.id)
         
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
+        if not get_state(username).get("transcription"):
+            await telegram_sender.answer(callback_query, "Транскрипция не найдена")
+            return
         
-        await callback_query.message.edit_text(
-            f"📝 **Результат транскрипции** (страница {current_page + 1}/{total_pages}):\n\n{pages[current_page]}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        if transcription_view.should_send_document(username):
+            await transcription_view.send_document(callback_query.message, username)
+            await telegram_sender.answer(callback_query, "Транскрипция длинная, отправляю файлом")
+            return
         
-        await callback_query.answer(f"Страница {current_page + 1} из {total_pages}")
-    
+        set_state(username, "current_page", 0)
+        body, reply_markup = transcription_view.render(username, 0)
+        
+        await telegram_sender.edit(callback_query.message, body, reply_markup=reply_markup)
+        
+        await telegram_sender.answer(callback_query, "Показываю транскрипцию")
+        
+    except Exception as e:
+        logger.error(f"Ошибка при показе транскрипции: {e}", exc_info=True)
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
+
+@app.on_callback_query(filters.regex(r"^(prev|next)_page$"))
+async def navigate_pages(client, callback_query):
+    try:
+        await transcription_view.navigate(callback_query)
     except Exception as e:
         logger.error(f"Ошибка при навигации по страницам: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 @app.on_callback_query(filters.regex(r"^page_info$"))
 async def page_info(client, callback_query):
     try:
-        username = callback_query.from_user.username or str(callback_query.from_user.id)
-        
-        pages = get_state(username).get("pages", [])
-        current_page = get_state(username).get("current_page", 0)
-        total_pages = len(pages)
-        
-        await callback_query.answer(f"Страница {current_page + 1} из {total_pages}")
+        await transcription_view.page_info(callback_query)
     except Exception as e:
         logger.error(f"Ошибка при показе информации о странице: {e}", exc_info=True)
-        await callback_query.answer("Произошла ошибка")
+        await telegram_sender.answer(callback_query, "Произошла ошибка")
 
 @app.on_callback_query(filters.regex(r"^process_gpt$"))
 async def process_gpt(client, callback_query):
@@ -572,12 +2694,12 @@ async def process_gpt(client, callback_query):
         transcription = get_state(username).get("transcription")
         
         if not transcription:
-            await callback_query.answer("Транскрипция не найдена")
+            await telegram_sender.answer(callback_query, "Транскрипция не найдена")
             return
             
         if not openai_client:
-            await callback_query.answer("ChatGPT недоступен")
-            await callback_query.message.edit_text(
+            await telegram_sender.answer(callback_query, "ChatGPT недоступен")
+            await telegram_sender.edit(callback_query.message,
                 "❌ Обработка через ChatGPT недоступна: API ключ не настроен.\n"
                 "Обратитесь к администратору бота.",
                 reply_markup=InlineKeyboardMarkup([
@@ -587,7 +2709,7 @@ async def process_gpt(client, callback_query):
             return
         
         # Получаем промпт пользователя или используем стандартный
-        prompt = user_prompts.get(username, DEFAULT_PROMPT)
+        prompt = get_current_prompt(username) or DEFAULT_PROMPT
         
         # Показываем текущий промпт и предлагаем действия
         keyboard = [
@@ -596,18 +2718,18 @@ async def process_gpt(client, callback_query):
             [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
         ]
         
-        await callback_query.message.edit_text(
+        await telegram_sender.edit(callback_query.message,
             "🧠 **Подготовка к обработке через ChatGPT**\n\n"
             f"📝 **Текущий промпт:**\n`{prompt}`\n\n"
             "Выберите действие:",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         
-        await callback_query.answer("Подготовка к обработке")
+        await telegram_sender.answer(callback_query, "Подготовка к обработке")
         
     except Exception as e:
         logger.error(f"Ошибка при подготовке к обработке через ChatGPT: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 def get_main_keyboard(username):
     """Возвращает основную клавиатуру для обработки промптов"""
@@ -647,7 +2769,7 @@ async def change_prompt(client, callback_query):
             display_prompt = (prompt[:40] + "...") if len(prompt) > 40 else prompt
             keyboard.append([InlineKeyboardButton(f"📜 {display_prompt}", callback_data=f"use_prompt_{i}")])
         
-        await callback_query.message.edit_text(
+        await telegram_sender.edit(callback_query.message,
             "📝 **Введите новый промпт**\n\n"
             "Отправьте текст вашего нового промпта в следующем сообщении.\n\n"
             "Примеры промптов:\n"
@@ -657,10 +2779,10 @@ async def change_prompt(client, callback_query):
             + (("Или выберите один из ваших предыдущих промптов:") if previous_prompts else ""),
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        await callback_query.answer("Введите новый промпт" + (" или выберите из истории" if previous_prompts else ""))
+        await telegram_sender.answer(callback_query, "Введите новый промпт" + (" или выберите из истории" if previous_prompts else ""))
     except Exception as e:
         logger.error(f"Ошибка при изменении промпта: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 @app.on_callback_query(filters.regex(r"^use_prompt_(\d+)$"))
 async def use_previous_prompt(client, callback_query):
@@ -679,16 +2801,16 @@ async def use_previous_prompt(client, callback_query):
             set_user_prompt(username, selected_prompt)
             
             # Возвращаемся к основному интерфейсу
-            await callback_query.message.edit_text(
+            await telegram_sender.edit(callback_query.message,
                 f"✅ Промпт выбран:\n\n`{selected_prompt}`\n\nТеперь отправьте текст для обработки.",
                 reply_markup=get_main_keyboard(username)  # Предполагается, что у вас есть эта функция
             )
-            await callback_query.answer("Промпт успешно выбран")
+            await telegram_sender.answer(callback_query, "Промпт успешно выбран")
         else:
-            await callback_query.answer("Промпт не найден")
+            await telegram_sender.answer(callback_query, "Промпт не найден")
     except Exception as e:
         logger.error(f"Ошибка при выборе предыдущего промпта: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 @app.on_callback_query(filters.regex(r"^manage_prompts$"))
 async def manage_prompts(client, callback_query):
@@ -697,7 +2819,7 @@ async def manage_prompts(client, callback_query):
         previous_prompts = get_user_prompts(username)
         
         if not previous_prompts:
-            await callback_query.answer("У вас нет сохраненных промптов")
+            await telegram_sender.answer(callback_query, "У вас нет сохраненных промптов")
             return
         
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="change_prompt")]]
@@ -710,16 +2832,16 @@ async def manage_prompts(client, callback_query):
                 InlineKeyboardButton("🗑️ Удалить", callback_data=f"delete_prompt_{i}")
             ])
         
-        await callback_query.message.edit_text(
+        await telegram_sender.edit(callback_query.message,
             "🗑️ **Управление сохраненными промптами**\n\n"
             "Выберите промпт для использования или удаления:",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         
-        await callback_query.answer("Выберите промпт для управления")
+        await telegram_sender.answer(callback_query, "Выберите промпт для управления")
     except Exception as e:
         logger.error(f"Ошибка при управлении промптами: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 @app.on_callback_query(filters.regex(r"^delete_prompt_(\d+)$"))
 async def delete_prompt(client, callback_query):
@@ -732,16 +2854,16 @@ async def delete_prompt(client, callback_query):
         
         if success:
             shortened_prompt = (removed_prompt[:20] + "...") if len(removed_prompt) > 20 else removed_prompt
-            await callback_query.answer(f"Промпт '{shortened_prompt}' удален")
+            await telegram_sender.answer(callback_query, f"Промпт '{shortened_prompt}' удален")
             
             # Возвращаемся к управлению промптами
             await manage_prompts(client, callback_query)
         else:
-            await callback_query.answer("Промпт не найден")
+            await telegram_sender.answer(callback_query, "Промпт не найден")
             
     except Exception as e:
         logger.error(f"Ошибка при удалении промпта: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
         
 @app.on_callback_query(filters.regex(r"^start_gpt_process$"))
 async def start_gpt_process(client, callback_query):
@@ -751,22 +2873,38 @@ async def start_gpt_process(client, callback_query):
         transcription = str(get_state(username).get("transcription"))
         
         if not transcription:
-            await callback_query.answer("Транскрипция не найдена")
+            await telegram_sender.answer(callback_query, "Транскрипция не найдена")
             return
             
-        prompt = str(user_prompts.get(username, DEFAULT_PROMPT))
+        prompt = get_current_prompt(username) or DEFAULT_PROMPT
         
-        status_msg = await callback_query.message.edit_text(
+        status_msg = await telegram_sender.edit(callback_query.message,
             "🧠 Обрабатываю текст с помощью ChatGPT...",
             reply_markup=None
         )
         
-        success, response = await process_with_chatgpt(transcription, prompt, callback_query.message)
+        on_progress = None
+        if GPT_STREAMING:
+            async def on_progress(partial_text):
+                if len(partial_text) > GPT_STREAM_PREVIEW_CHARS:
+                    partial_text = "…" + partial_text[-GPT_STREAM_PREVIEW_CHARS:]
+                progress_reporter.report(status_msg, f"🧠 Обрабатываю текст с помощью ChatGPT...\n\n{partial_text} ▌")
+        
+        async def on_status(status_text):
+            progress_reporter.report(status_msg, status_text)
+        
+        success, response = await process_with_chatgpt(
+            transcription,
+            prompt,
+            callback_query.message,
+            on_progress,
+            on_status
+        )
         
-        await status_msg.edit_text("✅ Обработка через ChatGPT завершена!")
+        progress_reporter.report(status_msg, "✅ Обработка через ChatGPT завершена!")
         
         if not success:
-            await callback_query.message.reply(
+            await telegram_sender.reply(callback_query.message,
                 f"❌ {response}",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
@@ -774,34 +2912,22 @@ async def start_gpt_process(client, callback_query):
             )
             return
         
-        page_size = 3000
-        pages = [response[i:i+page_size] for i in range(0, len(response), page_size)]
-        total_pages = len(pages)
-        
-        set_state(username, "gpt_pages", pages)
-        set_state(username, "current_gpt_page", 0)
-        
-        keyboard = []
+        gpt_view.set_text(username, response)
         
-        if total_pages > 1:
-            nav_buttons = []
-            nav_buttons.append(InlineKeyboardButton("◀️", callback_data="prev_gpt_page"))
-            nav_buttons.append(InlineKeyboardButton(f"1/{total_pages}", callback_data="gpt_page_info"))
-            nav_buttons.append(InlineKeyboardButton("▶️", callback_data="next_gpt_page"))
-            keyboard.append(nav_buttons)
+        if gpt_view.should_send_document(username):
+            await gpt_view.send_document(callback_query.message, username)
+            return
         
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
+        body, reply_markup = gpt_view.render(username, 0)
         
-        await callback_query.message.reply(
-            f"🧠 Страница 1/{total_pages}:\n\n{pages[0]}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await telegram_sender.reply(callback_query.message, body, reply_markup=reply_markup)
         
     except Exception as e:
         logger.error(f"Ошибка при обработке текста через ChatGPT: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
         
-        await callback_query.message.edit_text(
+        progress_reporter.discard(callback_query.message)
+        await telegram_sender.edit(callback_query.message,
             f"❌ Произошла ошибка при обработке текста: {str(e)}",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
@@ -811,75 +2937,18 @@ async def start_gpt_process(client, callback_query):
 @app.on_callback_query(filters.regex(r"^(prev|next)_gpt_page$"))
 async def navigate_gpt_pages(client, callback_query):
     try:
-        username = callback_query.from_user.username or str(callback_query.from_user.id)
-        action = callback_query.data.split("_")[0]  # prev или next
-        
-        # Получаем страницы и текущую страницу
-        pages = get_state(username).get("gpt_pages", [])
-        current_page = get_state(username).get("current_gpt_page", 0)
-        total_pages = len(pages)
-        
-        if not pages:
-            await callback_query.answer("Информация о страницах не найдена")
-            return
-            
-        # Обрабатываем действие
-        if action == "prev":
-            if current_page > 0:
-                current_page -= 1
-                set_state(username, "current_gpt_page", current_page)
-            else:
-                await callback_query.answer("Вы уже на первой странице")
-                return
-        elif action == "next":
-            if current_page < total_pages - 1:
-                current_page += 1
-                set_state(username, "current_gpt_page", current_page)
-            else:
-                await callback_query.answer("Вы уже на последней странице")
-                return
-            
-        # Создаем клавиатуру с навигацией
-        keyboard = []
-        
-        # Если страниц больше одной, добавляем кнопки навигации
-        if total_pages > 1:
-            nav_buttons = []
-            nav_buttons.append(InlineKeyboardButton("◀️", callback_data="prev_gpt_page"))
-            nav_buttons.append(InlineKeyboardButton(f"{current_page + 1}/{total_pages}", callback_data="gpt_page_info"))
-            nav_buttons.append(InlineKeyboardButton("▶️", callback_data="next_gpt_page"))
-            keyboard.append(nav_buttons)
-        
-        # Добавляем кнопку "Назад"
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")])
-        
-        # Обновляем сообщение с текущей страницей
-        await callback_query.message.edit_text(
-            f"🧠 **Результат обработки ChatGPT** (страница {current_page + 1}/{total_pages}):\n\n{pages[current_page]}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        
-        # Подтверждаем нажатие кнопки
-        await callback_query.answer(f"Страница {current_page + 1} из {total_pages}")
-    
+        await gpt_view.navigate(callback_query)
     except Exception as e:
         logger.error(f"Ошибка при навигации по страницам ChatGPT: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 @app.on_callback_query(filters.regex(r"^gpt_page_info$"))
 async def gpt_page_info(client, callback_query):
     try:
-        username = callback_query.from_user.username or str(callback_query.from_user.id)
-        
-        # Получаем информацию о страницах
-        pages = get_state(username).get("gpt_pages", [])
-        current_page = get_state(username).get("current_gpt_page", 0)
-        total_pages = len(pages)
-        
-        await callback_query.answer(f"Страница {current_page + 1} из {total_pages}")
+        await gpt_view.page_info(callback_query)
     except Exception as e:
         logger.error(f"Ошибка при показе информации о странице: {e}", exc_info=True)
-        await callback_query.answer("Произошла ошибка")
+        await telegram_sender.answer(callback_query, "Произошла ошибка")
 
 @app.on_callback_query(filters.regex(r"^back_to_gpt$"))
 async def back_to_gpt(client, callback_query):
@@ -890,7 +2959,7 @@ async def back_to_gpt(client, callback_query):
         set_state(username, "awaiting_prompt", False)
         
         # Получаем промпт пользователя
-        prompt = user_prompts.get(username, DEFAULT_PROMPT)
+        prompt = get_current_prompt(username) or DEFAULT_PROMPT
         
         # Показываем текущий промпт и предлагаем действия
         keyboard = [
@@ -899,18 +2968,18 @@ async def back_to_gpt(client, callback_query):
             [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
         ]
         
-        await callback_query.message.edit_text(
+        await telegram_sender.edit(callback_query.message,
             "🧠 **Подготовка к обработке через ChatGPT**\n\n"
             f"📝 **Текущий промпт:**\n`{prompt}`\n\n"
             "Выберите действие:",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         
-        await callback_query.answer("Вернулся к настройкам обработки")
+        await telegram_sender.answer(callback_query, "Вернулся к настройкам обработки")
         
     except Exception as e:
         logger.error(f"Ошибка при возврате к GPT: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 @app.on_callback_query(filters.regex(r"^back_to_menu$"))
 async def back_to_menu(client, callback_query):
@@ -919,11 +2988,11 @@ async def back_to_menu(client, callback_query):
         clear_state(username)
         
         await show_main_menu(client, callback_query.message, username)
-        await callback_query.answer("Вернулся в главное меню")
+        await telegram_sender.answer(callback_query, "Вернулся в главное меню")
         
     except Exception as e:
         logger.error(f"Ошибка при возврате в меню: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
         
         # В случае ошибки возвращаемся в главное меню
         await show_main_menu(client, callback_query.message, username)
@@ -933,28 +3002,29 @@ async def cancel_transcription(client, callback_query):
     try:
         username = callback_query.from_user.username or str(callback_query.from_user.id)
         
-        # Очищаем состояние пользователя
+        # Очищаем состояние пользователя и прерываем незаконченное скачивание
+        discard_media_download(get_state(username).get("file_path"))
         clear_state(username)
         
         # Возвращаемся в главное меню
         await show_main_menu(client, callback_query.message, username)
         
-        await callback_query.answer("Транскрипция отменена")
+        await telegram_sender.answer(callback_query, "Транскрипция отменена")
         
     except Exception as e:
         logger.error(f"Ошибка при отмене транскрипции: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 async def show_main_menu(client, message, username):
     """Показывает главное меню"""
-    prompt = user_prompts.get(username, DEFAULT_PROMPT)
+    prompt = get_current_prompt(username) or DEFAULT_PROMPT
     
     keyboard = [
         [InlineKeyboardButton("❓ Помощь", callback_data="show_help")]
     ]
     
     try:
-        await message.edit_text(
+        await telegram_sender.edit(message,
             "👋 Привет! Я бот для транскрипции аудио с возможностью обработки результата через ChatGPT.\n\n"
             "📱 **Что я умею:**\n"
             "• Автоматически определять язык аудио\n"
@@ -964,7 +3034,7 @@ async def show_main_menu(client, message, username):
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     except Exception:
-        await message.reply(
+        await telegram_sender.reply(message,
             "👋 Привет! Я бот для транскрипции аудио с возможностью обработки результата через ChatGPT.\n\n"
             "📱 **Что я умею:**\n"
             "• Автоматически определять язык аудио\n"
@@ -982,7 +3052,7 @@ async def show_help(client, callback_query):
             [InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu")]
         ]
         
-        await callback_query.message.edit_text(
+        await telegram_sender.edit(callback_query.message,
             "📋 **Как пользоваться этим ботом:**\n\n"
             "1. Отправьте голосовое сообщение или аудиофайл (MP3, OGG, WAV и др.)\n"
             "2. Выберите язык для транскрипции\n"
@@ -997,11 +3067,11 @@ async def show_help(client, callback_query):
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         
-        await callback_query.answer("Открываю справку")
+        await telegram_sender.answer(callback_query, "Открываю справку")
         
     except Exception as e:
         logger.error(f"Ошибка при показе справки: {e}", exc_info=True)
-        await callback_query.answer(f"Произошла ошибка: {str(e)}")
+        await telegram_sender.answer(callback_query, f"Произошла ошибка: {str(e)}")
 
 @app.on_message(filters.command("start"))
 async def start_command(client, message):
@@ -1012,7 +3082,7 @@ async def start_command(client, message):
 async def help_command(client, message):
     languages_list = "\n".join([f"• {name}" for code, name in SUPPORTED_LANGUAGES.items()])
     
-    await message.reply(
+    await telegram_sender.reply(message,
         "📋 **Как пользоваться этим ботом:**\n\n"
         "1. Отправьте голосовое сообщение или аудиофайл (MP3, OGG, WAV и др.)\n"
         "2. Выберите язык для транскрипции\n"
@@ -1036,7 +3106,7 @@ async def handle_text(client, message):
         add_user_prompt(username, new_prompt)
         set_state(username, "awaiting_prompt", False)
 
-        await message.reply(
+        await telegram_sender.reply(message,
             f"✅ Ваш промпт успешно сохранен!\n\n"
             f"📝 **Новый промпт:**\n`{new_prompt}`",
             reply_markup=InlineKeyboardMarkup([
@@ -1045,7 +3115,7 @@ async def handle_text(client, message):
         )
         return
     
-    await message.reply(
+    await telegram_sender.reply(message,
         "Пожалуйста, отправьте мне голосовое сообщение или аудиофайл для транскрипции.\n"
         "Используйте /help для получения справки."
     )
@@ -1059,11 +3129,11 @@ async def handle_audio(client, message):
         if message.document and not message.document.mime_type.startswith("audio/"):
             file_ext = os.path.splitext(message.document.file_name)[1].lower() if message.document.file_name else ""
             if file_ext not in [".mp3", ".ogg", ".wav", ".flac", ".m4a", ".aac"]:
-                await message.reply("Этот документ не похож на аудиофайл. Отправьте аудиофайл для транскрипции.")
+                await telegram_sender.reply(message, "Этот документ не похож на аудиофайл. Отправьте аудиофайл для транскрипции.")
                 return
         
         if get_state(username).get("transcribing", False):
-            await message.reply(
+            await telegram_sender.reply(message,
                 "У вас уже есть активная задача транскрипции. "
                 "Дождитесь ее завершения или отправьте новый файл для обработки."
             )
@@ -1072,42 +3142,121 @@ async def handle_audio(client, message):
         set_state(username, "transcribing", True)
         
         file_id = None
+        file_unique_id = None
         file_name = None
+        media_file = message.audio or message.voice or message.document
         
         if message.audio:
             file_id = message.audio.file_id
+            file_unique_id = message.audio.file_unique_id
             file_name = message.audio.file_name or f"audio_{message.id}.mp3"
         elif message.voice:
             file_id = message.voice.file_id
+            file_unique_id = message.voice.file_unique_id
             file_name = f"voice_{message.id}.ogg"
         elif message.document:
             file_id = message.document.file_id
+            file_unique_id = message.document.file_unique_id
             file_name = message.document.file_name or f"document_{message.id}"
         else:
-            await message.reply("Пожалуйста, отправьте аудиофайл.")
+            await telegram_sender.reply(message, "Пожалуйста, отправьте аудиофайл.")
             return
         
         file_name = f"{int(time.time())}_{file_name}"
         save_path = os.path.join(AUDIO_FILES_DIR, file_name)
         
+        set_state(username, "media", {
+            "file_id": file_id,
+            "file_unique_id": file_unique_id,
+            "save_path": save_path,
+            "file_size": getattr(media_file, "file_size", None),
+            "duration": getattr(media_file, "duration", None),
+        })
+        
+        # Уже виденный файл не скачиваем: транскрипция найдется в кэше по хэшу
+        content_hash = file_id_index.get(file_unique_id) if file_unique_id else None
+        set_state(username, "content_hash", content_hash)
+        if content_hash:
+            logger.info(f"Файл {file_unique_id} уже встречался, скачивание пропущено")
+            await show_language_selection(message, None)
+            return
+        
+        if MEDIA_PIPELINE:
+            # Язык можно выбрать, не дожидаясь скачивания: транскрипция подхватит поток
+            status_msg = await telegram_sender.reply(message, "⏳ Скачиваю файл...")
+            download = MediaDownload(file_id, save_path, getattr(media_file, "file_size", None), status_msg)
+            media_downloads[save_path] = download
+            download.start()
+            
+            def release_failed_download(_task):
+                # Без этого пользователь с оборванным скачиванием не сможет прислать новый файл
+                if download.error is not None and get_state(username).get("file_path") == save_path:
+                    media_downloads.pop(save_path, None)
+                    clear_state(username)
+            
+            download.add_done_callback(release_failed_download)
+            await show_language_selection(message, save_path)
+            return
+        
         # Скачивание файла
         success, result = await download_file(message, file_id, save_path)
         
         if success:
             await show_language_selection(message, save_path)
         else:
-            await message.reply(f"❌ Ошибка при скачивании файла: {result}")
+            await telegram_sender.reply(message, f"❌ Ошибка при скачивании файла: {result}")
             clear_state(username)
     
     except Exception as e:
         logger.error(f"Ошибка обработки аудиофайла: {e}", exc_info=True)
-        await message.reply(f"❌ Произошла ошибка при обработке аудиофайла: {str(e)}")
+        await telegram_sender.reply(message, f"❌ Произошла ошибка при обработке аудиофайла: {str(e)}")
         clear_state(username)
 
+state_flush_task = None
+session_eviction_task = None
+
+async def start_services():
+    """Запуск общих ресурсов бота"""
+    await assemblyai_client.start()
+    await webhook_receiver.start()
+    poll_scheduler.start()
+    transcription_queue.start()
+    telegram_sender.start()
+    progress_reporter.start()
+    global state_flush_task, session_eviction_task
+    state_flush_task = asyncio.create_task(state_flush_loop())
+    session_eviction_task = asyncio.create_task(session_eviction_loop())
+
+async def stop_services():
+    """Остановка общих ресурсов бота"""
+    if session_eviction_task:
+        session_eviction_task.cancel()
+    if state_flush_task:
+        state_flush_task.cancel()
+    await flush_state()
+    await transcription_queue.stop()
+    await progress_reporter.stop()
+    logger.info(f"Исходящие запросы к Telegram: {telegram_sender.stats()}")
+    await telegram_sender.stop()
+    await poll_scheduler.stop()
+    await webhook_receiver.stop()
+    await assemblyai_client.close()
+    if openai_client:
+        await openai_client.close()
+
+async def main():
+    await start_services()
+    try:
+        await app.start()
+        await idle()
+        await app.stop()
+    finally:
+        await stop_services()
+
 if __name__ == "__main__":
     try:
         print("Запуск бота...")
-        app.run()
+        app.run(main())
     except KeyboardInterrupt:
         print("\nОстановка бота...")
     except Exception as e: